@@ -1,5 +1,8 @@
 from django.contrib import admin
-from .models import User, PurchaseRequest
+from .models import User, PurchaseRequest, ApprovalStep, DocumentJob, SpendRollup
 
 admin.site.register(User)
-admin.site.register(PurchaseRequest)
\ No newline at end of file
+admin.site.register(PurchaseRequest)
+admin.site.register(ApprovalStep)
+admin.site.register(DocumentJob)
+admin.site.register(SpendRollup)
\ No newline at end of file
@@ -0,0 +1,127 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncMonth
+from django.utils import timezone
+
+from .models import PurchaseRequest, SpendRollup
+
+GROUP_BY_FIELDS = {
+    'month': 'month',
+    'status': 'status',
+    'vendor': 'vendor',
+    'created_by': 'created_by__username',
+}
+
+def normalize_vendor(vendor):
+    if not isinstance(vendor, str):
+        return ''
+    return vendor.strip()[:255]
+
+def spend_bucket(created_at, status, created_by_id, vendor):
+    """Rollup key of a request; months are taken in the current time zone, like TruncMonth"""
+    return (
+        timezone.localtime(created_at).date().replace(day=1),
+        status,
+        created_by_id,
+        normalize_vendor(vendor),
+    )
+
+def bucket_for(purchase_request):
+    proforma_data = purchase_request.proforma_data or {}
+    return spend_bucket(
+        purchase_request.created_at,
+        purchase_request.status,
+        purchase_request.created_by_id,
+        proforma_data.get('vendor'),
+    )
+
+def record_spend_changes(changes):
+    """Apply (before, after) pairs to the rollups, where each side is
+    (bucket, amount) or None for a request that did not / no longer exists.
+    Deltas are summed per bucket first, so a bulk transition costs one
+    UPDATE per touched bucket rather than one per request."""
+    deltas = defaultdict(lambda: [0, Decimal('0')])
+    for before, after in changes:
+        if before == after:
+            continue
+        if before is not None:
+            deltas[before[0]][0] -= 1
+            deltas[before[0]][1] -= Decimal(before[1])
+        if after is not None:
+            deltas[after[0]][0] += 1
+            deltas[after[0]][1] += Decimal(after[1])
+    
+    for (month, status, created_by_id, vendor), (count, amount) in sorted(deltas.items()):
+        if not count and not amount:
+            continue
+        bucket = SpendRollup.objects.filter(
+            month=month, status=status, created_by_id=created_by_id, vendor=vendor
+        )
+        if bucket.update(request_count=F('request_count') + count, total_amount=F('total_amount') + amount):
+            continue
+        try:
+            with transaction.atomic():
+                SpendRollup.objects.create(
+                    month=month, status=status, created_by_id=created_by_id, vendor=vendor,
+                    request_count=count, total_amount=amount
+                )
+        except IntegrityError:
+            # Another transaction created the bucket first.
+            bucket.update(request_count=F('request_count') + count, total_amount=F('total_amount') + amount)
+
+def rebuild_spend_rollups():
+    """Recompute every bucket from the purchase requests; returns the bucket count"""
+    totals = defaultdict(lambda: [0, Decimal('0')])
+    rows = (
+        PurchaseRequest.objects.order_by()
+        .values_list(TruncMonth('created_at'), 'status', 'created_by_id', 'proforma_data__vendor')
+        .annotate(request_count=Count('id'), total_amount=Sum('amount'))
+    )
+    for month, status, created_by_id, vendor, count, amount in rows.iterator():
+        # Vendors that only differ in whitespace share a bucket.
+        key = (month.date(), status, created_by_id, normalize_vendor(vendor))
+        totals[key][0] += count
+        totals[key][1] += Decimal(amount)
+    
+    with transaction.atomic():
+        SpendRollup.objects.all().delete()
+        SpendRollup.objects.bulk_create([
+            SpendRollup(
+                month=month, status=status, created_by_id=created_by_id, vendor=vendor,
+                request_count=count, total_amount=amount
+            )
+            for (month, status, created_by_id, vendor), (count, amount) in totals.items()
+        ], batch_size=1000)
+    return len(totals)
+
+def spend_summary(user, group_by, statuses=None, month_from=None, month_to=None):
+    """Sum the rollups over the requested dimensions; staff only see their own
+    spend, finance and approvers the whole company's (see spend_analytics)"""
+    queryset = SpendRollup.objects.filter(request_count__gt=0)
+    if user.role == 'staff':
+        queryset = queryset.filter(created_by=user)
+    if statuses:
+        queryset = queryset.filter(status__in=statuses)
+    if month_from:
+        queryset = queryset.filter(month__gte=month_from)
+    if month_to:
+        queryset = queryset.filter(month__lte=month_to)
+    
+    lookups = [GROUP_BY_FIELDS[name] for name in group_by]
+    rows = (
+        queryset.order_by(*lookups)
+        .values(*lookups)
+        .annotate(count=Sum('request_count'), total_amount=Sum('total_amount'))
+    )
+    results = []
+    for row in rows:
+        result = {name: row[GROUP_BY_FIELDS[name]] for name in group_by}
+        if 'month' in result:
+            result['month'] = result['month'].strftime('%Y-%m')
+        result['count'] = row['count']
+        result['total_amount'] = str(Decimal(row['total_amount']).quantize(Decimal('0.01')))
+        results.append(result)
+    return results
@@ -2,4 +2,9 @@ from django.apps import AppConfig
 
 class ApiConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
-    name = 'api'
\ No newline at end of file
+    name = 'api'
+    
+    def ready(self):
+        # Connects the receivers that drop cached users when they change and
+        # that add query timing to new database connections
+        from . import instrumentation, user_cache  # noqa: F401
\ No newline at end of file
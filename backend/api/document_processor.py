@@ -1,113 +1,360 @@
+import logging
 import pdfplumber
+import pytesseract
 import re
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import closing, contextmanager
 from decimal import Decimal
 from io import BytesIO
+from django.conf import settings
+from django.template.loader import render_to_string
+from .extraction_cache import file_content_hash, get_extraction_cache, make_key
+from .instrumentation import span, timed
+from .matching import get_vendor_index, match_receipt
 
-def extract_text_from_pdf(file):
-    """Extract text from PDF file"""
+# Bump whenever text extraction or field parsing rules change, so cached
+# results from the previous rules are no longer used.
+EXTRACTOR_VERSION = '4'
+
+# Characters carried over from the previous page when checking a new page for
+# required fields, so a label split across a page break is still seen.
+PAGE_OVERLAP_CHARS = 200
+
+logger = logging.getLogger(__name__)
+
+# Each OCR call runs a tesseract subprocess, so threads are enough to keep
+# OCR_MAX_PROCESSES of them busy in parallel.
+_ocr_executor = None
+
+def _get_ocr_executor():
+    global _ocr_executor
+    if _ocr_executor is None:
+        _ocr_executor = ThreadPoolExecutor(
+            max_workers=settings.OCR_MAX_PROCESSES,
+            thread_name_prefix='ocr'
+        )
+    return _ocr_executor
+
+@timed('document.ocr')
+def ocr_image(image):
+    """Run tesseract on a page image, giving up after OCR_PAGE_TIMEOUT seconds.
+    Returns None when OCR fails or times out."""
     try:
-        text = ""
-        with pdfplumber.open(file) as pdf:
+        return pytesseract.image_to_string(image, timeout=settings.OCR_PAGE_TIMEOUT)
+    except (RuntimeError, OSError, pytesseract.TesseractError) as e:
+        logger.warning("OCR failed for page: %s", e)
+        return None
+
+class PartialText(str):
+    """Text from a read that failed, or where some page's OCR failed or timed out.
+    It is used like any other text, but neither it nor the fields parsed from it
+    are cached, so the next read of the document tries again."""
+
+@contextmanager
+def open_binary(file):
+    """Yield a seekable binary stream for a path, Django file or file-like object"""
+    if isinstance(file, str) or hasattr(file, '__fspath__'):
+        with open(file, 'rb') as f:
+            yield f
+        return
+    
+    file.seek(0)
+    try:
+        yield file
+    finally:
+        file.seek(0)
+
+def iter_pdf_pages(stream, max_pages):
+    """Yield the text of each page in order, OCR-ing pages that have no text layer
+    (None for a page whose OCR failed)
+    
+    Image-only pages are rasterized here and OCR'd in the background, with at
+    most OCR_MAX_PAGES_IN_FLIGHT of them outstanding for this document, so the
+    following pages are read while earlier ones are still being recognised.
+    """
+    pending = deque()
+    in_flight = 0
+    try:
+        with pdfplumber.open(stream, pages=range(1, max_pages + 1)) as pdf:
             for page in pdf.pages:
-                text += page.extract_text() or ""
-        return text
+                text = page.extract_text() or ""
+                if not text.strip() and settings.OCR_ENABLED:
+                    image = page.to_image(resolution=settings.OCR_RESOLUTION).original
+                    pending.append(_get_ocr_executor().submit(ocr_image, image))
+                    in_flight += 1
+                else:
+                    pending.append(text)
+                page.flush_cache()
+                
+                while pending and (
+                    not isinstance(pending[0], Future) or
+                    pending[0].done() or
+                    in_flight >= settings.OCR_MAX_PAGES_IN_FLIGHT
+                ):
+                    item = pending.popleft()
+                    if isinstance(item, Future):
+                        in_flight -= 1
+                        item = item.result()
+                    yield item
+            
+            while pending:
+                item = pending.popleft()
+                yield item.result() if isinstance(item, Future) else item
+    finally:
+        for item in pending:
+            if isinstance(item, Future):
+                item.cancel()
+
+def _missing_required_fields(text, missing):
+    return {
+        field for field in missing
+        if not any(pattern.search(text) for pattern in REQUIRED_FIELD_PATTERNS[field])
+    }
+
+@timed('document.text')
+def collect_pdf_text(stream):
+    """Read pages until a labelled total, invoice number and vendor have all
+    appeared, or a budget runs out"""
+    max_bytes = settings.DOCUMENT_MAX_TEXT_BYTES
+    parts = []
+    size = 0
+    missing = set(REQUIRED_FIELD_PATTERNS)
+    tail = ""
+    complete = True
+    
+    with closing(iter_pdf_pages(stream, settings.DOCUMENT_MAX_PAGES)) as pages:
+        for page_text in pages:
+            if page_text is None:
+                complete = False
+                continue
+            encoded = page_text.encode()
+            if size + len(encoded) > max_bytes:
+                parts.append(encoded[:max_bytes - size].decode(errors='ignore'))
+                break
+            parts.append(page_text)
+            size += len(encoded)
+            
+            window = tail + page_text
+            missing = _missing_required_fields(window, missing)
+            if not missing:
+                break
+            tail = window[-PAGE_OVERLAP_CHARS:]
+    
+    text = "".join(parts)
+    # An empty read is as likely a transient OCR problem as a blank document
+    return text if complete and text.strip() else PartialText(text)
+
+def _parse_pdf_text(stream):
+    try:
+        return collect_pdf_text(stream)
+    except Exception as e:
+        return PartialText(f"Error extracting text: {str(e)}")
+
+def _cached(kind, digest, compute):
+    """Cached result of compute(), which returns (value, complete). Incomplete
+    values are returned without being stored."""
+    cache = get_extraction_cache()
+    key = make_key(kind, EXTRACTOR_VERSION, digest)
+    with span('document.cache'):
+        value = cache.get(key)
+    if value is None:
+        value, complete = compute()
+        if complete:
+            cache.set(key, value)
+    return value
+
+def _text_for_stream(stream, digest):
+    def compute():
+        text = _parse_pdf_text(stream)
+        return text, not isinstance(text, PartialText)
+    return _cached('text', digest, compute)
+
+def _parsed_for_stream(kind, stream, digest, parse):
+    def compute():
+        text = _text_for_stream(stream, digest)
+        return parse(text), not isinstance(text, PartialText)
+    return _cached(kind, digest, compute)
+
+def extract_text_from_pdf(file):
+    """Extract text from PDF file, reusing cached text for identical file contents"""
+    try:
+        with open_binary(file) as stream:
+            return _text_for_stream(stream, file_content_hash(stream))
     except Exception as e:
         return f"Error extracting text: {str(e)}"
 
 def extract_proforma_data(file):
     """Extract key data from proforma invoice"""
-    text = extract_text_from_pdf(file)
-    
+    with open_binary(file) as stream:
+        digest = file_content_hash(stream)
+        return _parsed_for_stream('proforma', stream, digest, _parse_proforma)
+
+@timed('document.parse')
+def _parse_proforma(text):
+    fields = extract_fields(text)
     data = {
-        'vendor': extract_vendor(text),
-        'items': extract_items(text),
-        'total_amount': extract_amount(text),
-        'date': extract_date(text),
-        'invoice_number': extract_invoice_number(text),
+        'vendor': fields['vendor'],
+        'items': fields['items'],
+        'total_amount': fields['total_amount'],
+        'date': fields['date'],
+        'invoice_number': fields['invoice_number'],
         'raw_text': text[:500]  # Store first 500 chars
     }
     
     return data
 
-def extract_vendor(text):
-    """Extract vendor name from text"""
-    patterns = [
-        r'(?:Vendor|Supplier|From|Company):\s*([A-Za-z\s&.,]+)',
-        r'([A-Z][A-Za-z\s&.,]+)\n.*(?:Address|Tel|Email)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1).strip()
-    
-    lines = text.split('\n')
-    if lines:
-        return lines[0].strip()
+VENDOR_PATTERN = re.compile(r'(?:Vendor|Supplier|From|Company):\s*([A-Za-z\s&.,]+)', re.IGNORECASE)
+# A vendor line above an address block. It can only match from the first letter
+# of a run of [A-Za-z\s&.,], so the lookbehind pins it to run starts instead of
+# retrying from every later letter in the run.
+VENDOR_BLOCK_PATTERN = re.compile(
+    r'(?<![A-Za-z\s&.,])[\s&.,]*([A-Z][A-Za-z\s&.,]+)\n.*(?:Address|Tel|Email)', re.IGNORECASE
+)
+AMOUNT_PATTERNS = [
+    re.compile(r'(?:Total|Amount|Grand Total|Sum):\s*\$?\s*([\d,]+\.?\d*)', re.IGNORECASE),
+    re.compile(r'\$\s*([\d,]+\.\d{2})', re.IGNORECASE),
+]
+DECIMAL_PATTERN = re.compile(r'\d+\.\d{2}')
+DATE_PATTERNS = [
+    re.compile(r'\d{1,2}/\d{1,2}/\d{2,4}', re.IGNORECASE),
+    re.compile(r'\d{1,2}-\d{1,2}-\d{2,4}', re.IGNORECASE),
+    re.compile(r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{1,2},?\s+\d{4}', re.IGNORECASE),
+]
+INVOICE_NUMBER_PATTERNS = [
+    re.compile(r'(?:Invoice|Proforma|Ref|No|Number)[\s#:]*([A-Z0-9-]+)', re.IGNORECASE),
+    re.compile(r'#([A-Z0-9-]+)', re.IGNORECASE),
+]
+INVOICE_LABEL_PATTERN = re.compile(
+    r'(?:Invoice|Proforma|Ref)\s*(?:No\.|(?:No|Number)?\s*[#:])[\s#:]*[A-Z0-9-]+', re.IGNORECASE
+)
+# What collect_pdf_text waits for before it stops reading pages. Only labelled
+# values count: a bare "$120.00", "No" or a line above an address can turn up
+# on page 1 while the real total or vendor label is on a later page.
+REQUIRED_FIELD_PATTERNS = {
+    'total_amount': [AMOUNT_PATTERNS[0]],
+    'invoice_number': [INVOICE_LABEL_PATTERN],
+    'vendor': [VENDOR_PATTERN],
+}
+
+# Words that every match of the case-insensitive patterns has to start with
+# (or, for the vendor block, contain). Finding them with str.find on a
+# lowercased copy is much cheaper than letting re scan case-insensitively.
+FIELD_KEYWORDS = {
+    'vendor': ('vendor', 'supplier', 'from', 'company'),
+    'vendor_block': ('address', 'tel', 'email'),
+    'amount': ('total', 'amount', 'sum'),
+    'date': ('jan', 'feb', 'mar', 'apr', 'may', 'jun', 'jul', 'aug', 'sep', 'oct', 'nov', 'dec'),
+    'invoice_number': ('invoice', 'proforma', 'ref', 'no', 'number'),
+}
+
+def _keyword_offsets(text):
+    """Earliest offset at which each keyword-led pattern could match, or -1 if it cannot"""
+    if not text.isascii():
+        # Case folding outside ASCII can change lengths or match extra
+        # characters, so fall back to searching the whole text.
+        return dict.fromkeys(FIELD_KEYWORDS, 0)
     
-    return "Unknown Vendor"
+    lowered = text.lower()
+    offsets = {}
+    for field, keywords in FIELD_KEYWORDS.items():
+        found = [i for i in (lowered.find(keyword) for keyword in keywords) if i != -1]
+        offsets[field] = min(found) if found else -1
+    return offsets
 
-def extract_items(text):
-    """Extract items from text"""
+def _search(pattern, text, offset):
+    if offset == -1:
+        return None
+    return pattern.search(text, offset)
+
+def _scan_lines(lines):
+    """Collect line items and the last decimal amount in one pass over the lines"""
     items = []
-    
-    lines = text.split('\n')
+    last_amount = None
     for line in lines:
-        if re.search(r'\d+\.\d{2}', line) and len(line.split()) > 2:
-            items.append(line.strip())
+        amounts = DECIMAL_PATTERN.findall(line)
+        if amounts:
+            last_amount = amounts[-1]
+            if len(items) < 10 and len(line.split()) > 2:
+                items.append(line.strip())
+    return items, last_amount
+
+def _find_vendor(text, lines, offsets):
+    match = _search(VENDOR_PATTERN, text, offsets['vendor'])
+    if not match and offsets['vendor_block'] != -1:
+        match = VENDOR_BLOCK_PATTERN.search(text)
+    if match:
+        return match.group(1).strip()
     
-    return items[:10] if items else ["Item details not extracted"]
+    return lines[0].strip()
 
-def extract_amount(text):
-    """Extract total amount from text"""
-    patterns = [
-        r'(?:Total|Amount|Grand Total|Sum):\s*\$?\s*([\d,]+\.?\d*)',
-        r'\$\s*([\d,]+\.\d{2})',
+def _find_amount(text, offsets, last_amount):
+    candidates = [
+        _search(AMOUNT_PATTERNS[0], text, offsets['amount']),
+        AMOUNT_PATTERNS[1].search(text),
     ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
+    for match in candidates:
         if match:
-            amount_str = match.group(1).replace(',', '')
             try:
-                return float(amount_str)
-            except:
+                return float(match.group(1).replace(',', ''))
+            except ValueError:
                 pass
     
-    amounts = re.findall(r'\d+\.\d{2}', text)
-    if amounts:
-        return float(amounts[-1])
+    if last_amount:
+        return float(last_amount)
     
     return 0.0
 
+def _find_date(text, offsets):
+    match = (
+        DATE_PATTERNS[0].search(text) or
+        DATE_PATTERNS[1].search(text) or
+        _search(DATE_PATTERNS[2], text, offsets['date'])
+    )
+    return match.group(0) if match else "Date not found"
+
+def _find_invoice_number(text, offsets):
+    match = (
+        _search(INVOICE_NUMBER_PATTERNS[0], text, offsets['invoice_number']) or
+        INVOICE_NUMBER_PATTERNS[1].search(text)
+    )
+    return match.group(1) if match else "N/A"
+
+def extract_fields(text):
+    """Extract vendor, items, total amount, date and invoice number in one pass"""
+    lines = text.split('\n')
+    offsets = _keyword_offsets(text)
+    items, last_amount = _scan_lines(lines)
+    
+    return {
+        'vendor': _find_vendor(text, lines, offsets),
+        'items': items or ["Item details not extracted"],
+        'total_amount': _find_amount(text, offsets, last_amount),
+        'date': _find_date(text, offsets),
+        'invoice_number': _find_invoice_number(text, offsets),
+    }
+
+def extract_vendor(text):
+    """Extract vendor name from text"""
+    return _find_vendor(text, text.split('\n'), _keyword_offsets(text))
+
+def extract_items(text):
+    """Extract items from text"""
+    items, _ = _scan_lines(text.split('\n'))
+    return items or ["Item details not extracted"]
+
+def extract_amount(text):
+    """Extract total amount from text"""
+    _, last_amount = _scan_lines(text.split('\n'))
+    return _find_amount(text, _keyword_offsets(text), last_amount)
+
 def extract_date(text):
     """Extract date from text"""
-    patterns = [
-        r'\d{1,2}/\d{1,2}/\d{2,4}',
-        r'\d{1,2}-\d{1,2}-\d{2,4}',
-        r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{1,2},?\s+\d{4}',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(0)
-    
-    return "Date not found"
+    return _find_date(text, _keyword_offsets(text))
 
 def extract_invoice_number(text):
     """Extract invoice/proforma number"""
-    patterns = [
-        r'(?:Invoice|Proforma|Ref|No|Number)[\s#:]*([A-Z0-9-]+)',
-        r'#([A-Z0-9-]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, text, re.IGNORECASE)
-        if match:
-            return match.group(1)
-    
-    return "N/A"
+    return _find_invoice_number(text, _keyword_offsets(text))
 
 def generate_purchase_order(request):
     """Generate purchase order data from approved request"""
@@ -121,38 +368,42 @@ def generate_purchase_order(request):
         'total_amount': str(request.amount),
         'approved_by_level_1': request.level_1_approver.get_full_name() if request.level_1_approver else 'N/A',
         'approved_by_level_2': request.level_2_approver.get_full_name() if request.level_2_approver else 'N/A',
+        'approvals': [
+            {
+                'level': step.level,
+                'approved_by': step.decided_by.get_full_name() if step.decided_by else 'N/A',
+                'approved_at': step.decided_at.isoformat() if step.decided_at else None,
+            }
+            for step in request.approval_steps.all() if step.status == 'approved'
+        ],
         'status': 'APPROVED',
         'notes': f"Purchase order for: {request.title}"
     }
     
     return po_data
 
+@timed('document.render_po')
+def render_purchase_order(request, po_data):
+    """Render the stored purchase order document"""
+    return render_to_string('purchase_order.html', {'request': request, 'po': po_data})
+
+def extract_receipt_data(file):
+    """Extract the fields a receipt is matched on, reusing cached data for identical files"""
+    with open_binary(file) as stream:
+        digest = file_content_hash(stream)
+        return _parsed_for_stream('receipt', stream, digest, _parse_receipt)
+
+@timed('document.parse')
+def _parse_receipt(text):
+    fields = extract_fields(text)
+    return {
+        'vendor': fields['vendor'],
+        'amount': fields['total_amount'],
+        'items': fields['items'],
+    }
+
 def validate_receipt(receipt_file, purchase_order_data):
     """Validate receipt against purchase order"""
-    receipt_text = extract_text_from_pdf(receipt_file)
-    receipt_data = {
-        'vendor': extract_vendor(receipt_text),
-        'amount': extract_amount(receipt_text),
-        'items': extract_items(receipt_text),
-    }
-    
-    discrepancies = []
-    
-    po_vendor = purchase_order_data.get('vendor', '').lower()
-    receipt_vendor = receipt_data.get('vendor', '').lower()
-    if po_vendor not in receipt_vendor and receipt_vendor not in po_vendor:
-        discrepancies.append(f"Vendor mismatch: PO='{purchase_order_data.get('vendor')}' vs Receipt='{receipt_data.get('vendor')}'")
-    
-    po_amount = float(purchase_order_data.get('total_amount', 0))
-    receipt_amount = receipt_data.get('amount', 0)
-    if abs(po_amount - receipt_amount) > 0.01:
-        discrepancies.append(f"Amount mismatch: PO=${po_amount:.2f} vs Receipt=${receipt_amount:.2f}")
-    
-    validation_result = {
-        'is_valid': len(discrepancies) == 0,
-        'discrepancies': discrepancies,
-        'receipt_data': receipt_data,
-        'message': 'Receipt validated successfully' if len(discrepancies) == 0 else 'Discrepancies found'
-    }
-    
-    return validation_result
\ No newline at end of file
+    receipt_data = extract_receipt_data(receipt_file)
+    with span('receipt.match'):
+        return match_receipt(receipt_data, purchase_order_data, get_vendor_index())
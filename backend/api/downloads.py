@@ -0,0 +1,107 @@
+import mimetypes
+import os
+import re
+from urllib.parse import quote
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header, http_date, parse_http_date_safe
+from rest_framework.renderers import BaseRenderer, JSONRenderer
+
+RANGE_PATTERN = re.compile(r'^bytes=(\d*)-(\d*)$')
+READ_SIZE = 64 * 1024
+
+class DocumentRenderer(BaseRenderer):
+    """Lets document downloads be negotiated for any Accept header; errors still render as JSON"""
+    media_type = '*/*'
+    format = None
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if isinstance(data, bytes):
+            return data
+        return JSONRenderer().render(data)
+
+def parse_range(header, size):
+    """(start, end) of a single byte range, inclusive; None to send the whole file.
+    Raises ValueError for a range that lies outside the file."""
+    match = RANGE_PATTERN.match(header or '')
+    if not match or not any(match.groups()):
+        # Absent, malformed or multi-part ranges: answer with the full file
+        return None
+    first, last = match.groups()
+    if not first:
+        # Suffix range: the final `last` bytes
+        length = int(last)
+        if length == 0 or size == 0:
+            raise ValueError(header)
+        return max(size - length, 0), size - 1
+    start = int(first)
+    end = min(int(last), size - 1) if last else size - 1
+    if start >= size or start > end:
+        raise ValueError(header)
+    return start, end
+
+def _read_range(f, start, length):
+    try:
+        f.seek(start)
+        while length > 0:
+            block = f.read(min(READ_SIZE, length))
+            if not block:
+                break
+            length -= len(block)
+            yield block
+    finally:
+        f.close()
+
+def document_response(request, field_file):
+    """Send a stored document. With DOCUMENT_SENDFILE_BACKEND set, the front proxy
+    does the transfer (and Range handling); otherwise Django streams it."""
+    name = os.path.basename(field_file.name)
+    content_type = mimetypes.guess_type(name)[0] or 'application/octet-stream'
+    storage = field_file.storage
+    backend = settings.DOCUMENT_SENDFILE_BACKEND
+
+    if backend:
+        response = HttpResponse(content_type=content_type)
+        if backend == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = settings.DOCUMENT_SENDFILE_PREFIX + quote(field_file.name)
+        else:
+            response['X-Sendfile'] = storage.path(field_file.name)
+        response['Content-Disposition'] = content_disposition_header(False, name)
+        return response
+
+    size = storage.size(field_file.name)
+    try:
+        last_modified = http_date(storage.get_modified_time(field_file.name).timestamp())
+    except NotImplementedError:
+        last_modified = None
+
+    # A range only applies to the version of the file the client already has
+    byte_range = None
+    if_range = request.headers.get('If-Range')
+    if not if_range or (last_modified and parse_http_date_safe(if_range) == parse_http_date_safe(last_modified)):
+        try:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        except ValueError:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+
+    f = storage.open(field_file.name, 'rb')
+    if byte_range is None:
+        # Uses the server's file wrapper (sendfile) where there is one
+        response = FileResponse(f, content_type=content_type)
+    else:
+        start, end = byte_range
+        response = StreamingHttpResponse(
+            _read_range(f, start, end - start + 1), status=206, content_type=content_type
+        )
+        response['Content-Length'] = end - start + 1
+        response['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(False, name)
+    if last_modified:
+        response['Last-Modified'] = last_modified
+    return response
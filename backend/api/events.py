@@ -0,0 +1,160 @@
+import asyncio
+import json
+import threading
+
+from django.conf import settings
+from django.db import transaction
+from django.utils.module_loading import import_string
+
+from .models import queue_contains
+
+class Subscription:
+    """Events for one connected client, queued on that client's event loop"""
+
+    def __init__(self, broker, max_queued):
+        self.broker = broker
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue(maxsize=max_queued)
+        self.overflowed = False
+
+    def put(self, event):
+        # Publishers run in request threads, not on the subscriber's loop
+        self.loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            # The client is too far behind to catch up event by event
+            self.overflowed = True
+
+    async def get(self, timeout):
+        return await asyncio.wait_for(self.queue.get(), timeout)
+
+    def reset(self):
+        while not self.queue.empty():
+            self.queue.get_nowait()
+        self.overflowed = False
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+class EventBroker:
+    """Base class for request change brokers: publish() from any thread, subscribe() on an event loop"""
+
+    def __init__(self, max_queued=100):
+        self.max_queued = max_queued
+
+    def publish(self, event):
+        raise NotImplementedError
+
+    def subscribe(self):
+        raise NotImplementedError
+
+    def unsubscribe(self, subscription):
+        raise NotImplementedError
+
+class InProcessBroker(EventBroker):
+    """Fans events out to subscribers in this process only"""
+
+    def __init__(self, max_queued=100):
+        super().__init__(max_queued)
+        self._lock = threading.Lock()
+        self._subscriptions = set()
+
+    def publish(self, event):
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for subscription in subscriptions:
+            try:
+                subscription.put(event)
+            except RuntimeError:
+                # The subscriber's event loop has been closed
+                self.unsubscribe(subscription)
+
+    def subscribe(self):
+        subscription = Subscription(self, self.max_queued)
+        with self._lock:
+            self._subscriptions.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            self._subscriptions.discard(subscription)
+
+_broker = None
+_broker_lock = threading.Lock()
+
+def get_event_broker():
+    """Return the configured broker, built once per process from settings.EVENT_BROKER"""
+    global _broker
+    if _broker is None:
+        with _broker_lock:
+            if _broker is None:
+                config = settings.EVENT_BROKER
+                _broker = import_string(config['BACKEND'])(max_queued=config['MAX_QUEUED'])
+    return _broker
+
+def request_state(purchase_request):
+    """What PurchaseRequest.is_visible_to depends on, plus the status"""
+    return {
+        'status': purchase_request.status,
+        'current_role': purchase_request.current_role(),
+        'created_by_id': purchase_request.created_by_id,
+    }
+
+def publish_request_events(changes):
+    """Publish (event type, request, state before the change) triples once the transaction commits"""
+    events = [
+        {
+            'type': event_type,
+            'id': purchase_request.pk,
+            'before': before,
+            'after': request_state(purchase_request),
+        }
+        for event_type, purchase_request, before in changes
+    ]
+    if not events:
+        return
+
+    def publish():
+        broker = get_event_broker()
+        for event in events:
+            broker.publish(event)
+
+    transaction.on_commit(publish)
+
+def _visible(user, state):
+    return state is not None and queue_contains(user, state['created_by_id'], state['current_role'])
+
+async def stream_request_events(user):
+    """Server-Sent Events for changes entering, inside or leaving the user's queue.
+    Ends after EVENT_STREAM_MAX_AGE seconds; clients reconnect after `retry`."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + settings.EVENT_STREAM_MAX_AGE
+    subscription = get_event_broker().subscribe()
+    try:
+        yield f"retry: {settings.EVENT_STREAM_RETRY_MS}\n\n"
+        while loop.time() < deadline:
+            try:
+                event = await subscription.get(settings.EVENT_STREAM_HEARTBEAT)
+            except asyncio.TimeoutError:
+                # Comment line; also how a dropped connection gets noticed
+                yield ": keep-alive\n\n"
+                continue
+
+            if subscription.overflowed:
+                subscription.reset()
+                yield "event: reset\ndata: {}\n\n"
+                continue
+
+            if not (_visible(user, event['before']) or _visible(user, event['after'])):
+                continue
+            data = json.dumps({
+                'id': event['id'],
+                'status': event['after']['status'],
+                'in_queue': _visible(user, event['after']),
+            })
+            yield f"event: {event['type']}\ndata: {data}\n\n"
+    finally:
+        subscription.close()
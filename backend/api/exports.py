@@ -0,0 +1,65 @@
+import csv
+import json
+
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import OuterRef, Subquery
+
+from .models import ApprovalStep
+
+# (header, queryset lookup). JSON keys are pulled out in SQL so the blob
+# columns never reach Python.
+EXPORT_COLUMNS = [
+    ('id', 'id'),
+    ('title', 'title'),
+    ('amount', 'amount'),
+    ('status', 'status'),
+    ('created_by', 'created_by__username'),
+    ('created_at', 'created_at'),
+    ('level_1_approver', 'level_1_approver'),
+    ('level_1_approved_at', 'level_1_approved_at'),
+    ('level_2_approver', 'level_2_approver'),
+    ('level_2_approved_at', 'level_2_approved_at'),
+    ('rejected_by', 'rejected_by__username'),
+    ('rejected_at', 'rejected_at'),
+    ('vendor', 'proforma_data__vendor'),
+    ('invoice_number', 'proforma_data__invoice_number'),
+    ('po_number', 'purchase_order_data__po_number'),
+    ('receipt_valid', 'receipt_validation__is_valid'),
+]
+
+EXPORT_CHUNK_SIZE = 2000
+
+def _approval(level, lookup):
+    """Who approved, or when, the request's given level; one lookup in the
+    (purchase_request, level) unique index per row"""
+    return Subquery(
+        ApprovalStep.objects.filter(purchase_request=OuterRef('pk'), level=level, status='approved')
+        .values(lookup)[:1]
+    )
+
+APPROVAL_COLUMNS = {
+    f'level_{level}_{name}': _approval(level, lookup)
+    for level in (1, 2)
+    for name, lookup in (('approver', 'decided_by__username'), ('approved_at', 'decided_at'))
+}
+
+def export_rows(queryset):
+    """Yield one tuple per request, read through a server-side cursor"""
+    lookups = [lookup for _, lookup in EXPORT_COLUMNS]
+    return queryset.annotate(**APPROVAL_COLUMNS).values_list(*lookups).iterator(chunk_size=EXPORT_CHUNK_SIZE)
+
+class _Echo:
+    """File-like object whose write() hands the line straight back to the caller"""
+    def write(self, value):
+        return value
+
+def stream_csv(rows):
+    writer = csv.writer(_Echo())
+    yield writer.writerow([header for header, _ in EXPORT_COLUMNS])
+    for row in rows:
+        yield writer.writerow(row)
+
+def stream_ndjson(rows):
+    headers = [header for header, _ in EXPORT_COLUMNS]
+    for row in rows:
+        yield json.dumps(dict(zip(headers, row)), cls=DjangoJSONEncoder) + '\n'
@@ -0,0 +1,180 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+
+from django.conf import settings
+from django.db.models import Sum
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+def file_content_hash(stream, chunk_size=1024 * 1024):
+    """SHA-256 hex digest of a binary stream, read in chunks and rewound afterwards"""
+    digest = hashlib.sha256()
+    stream.seek(0)
+    for chunk in iter(lambda: stream.read(chunk_size), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+# Checking the store's size scans every entry, so a process only checks after
+# writing another 1/EVICT_CHECK_FRACTION of max_bytes since its last check. The
+# store can overshoot max_bytes by that much per process in between.
+EVICT_CHECK_FRACTION = 16
+
+def make_key(kind, version, digest):
+    return f"{kind}-{version}-{digest}"
+
+class ExtractionCacheStore:
+    """Base class for extraction cache stores, with per-process hit/miss counters"""
+
+    def __init__(self, max_bytes, location=None):
+        self.max_bytes = max_bytes
+        self.location = location
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._written = 0
+
+    def get(self, key):
+        value = self._get(key)
+        with self._lock:
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return value
+
+    def set(self, key, value):
+        payload = json.dumps(value)
+        size = len(payload.encode())
+        self._set(key, payload, size)
+        with self._lock:
+            self._written += size
+            check = self._written * EVICT_CHECK_FRACTION >= self.max_bytes
+            if check:
+                self._written = 0
+        if check:
+            self._evict()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _get(self, key):
+        raise NotImplementedError
+
+    def _set(self, key, payload, size):
+        raise NotImplementedError
+
+    def _evict(self):
+        """Drop least recently used entries until the store fits in max_bytes"""
+        raise NotImplementedError
+
+class DatabaseStore(ExtractionCacheStore):
+    """Stores entries in the ExtractionCacheEntry table, evicting least recently used"""
+
+    def _get(self, key):
+        from .models import ExtractionCacheEntry
+
+        entry = ExtractionCacheEntry.objects.filter(key=key).values_list('payload', flat=True).first()
+        if entry is None:
+            return None
+        ExtractionCacheEntry.objects.filter(key=key).update(last_used_at=timezone.now())
+        return json.loads(entry)
+
+    def _set(self, key, payload, size):
+        from .models import ExtractionCacheEntry
+
+        ExtractionCacheEntry.objects.bulk_create(
+            [ExtractionCacheEntry(key=key, payload=payload, size=size)],
+            ignore_conflicts=True
+        )
+
+    def _evict(self):
+        from .models import ExtractionCacheEntry
+
+        total = ExtractionCacheEntry.objects.aggregate(total=Sum('size'))['total'] or 0
+        if total <= self.max_bytes:
+            return
+
+        stale = []
+        for key, size in ExtractionCacheEntry.objects.order_by('last_used_at').values_list('key', 'size').iterator():
+            if total <= self.max_bytes:
+                break
+            stale.append(key)
+            total -= size
+        ExtractionCacheEntry.objects.filter(key__in=stale).delete()
+
+class FileSystemStore(ExtractionCacheStore):
+    """Stores one JSON file per entry; file mtime tracks recency for LRU eviction"""
+
+    def _path(self, key):
+        return os.path.join(self.location, key[-2:], f"{key}.json")
+
+    def _get(self, key):
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                payload = f.read()
+            os.utime(path)
+        except (FileNotFoundError, ValueError):
+            return None
+        return json.loads(payload)
+
+    def _set(self, key, payload, size):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            f.write(payload)
+        os.replace(tmp_path, path)
+
+    def _evict(self):
+        entries = []
+        total = 0
+        for root, _, files in os.walk(self.location):
+            for name in files:
+                if not name.endswith('.json'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        if total <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+_store = None
+_store_lock = threading.Lock()
+
+def get_extraction_cache():
+    """Return the configured store, built once per process from settings.EXTRACTION_CACHE"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = settings.EXTRACTION_CACHE
+                _store = import_string(config['BACKEND'])(
+                    max_bytes=config['MAX_BYTES'],
+                    location=config.get('LOCATION'),
+                )
+    return _store
@@ -0,0 +1,202 @@
+import contextvars
+import random
+import threading
+import time
+from collections import defaultdict
+from functools import wraps
+
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Marks a request that was not sampled, so spans and queries inside it are not
+# timed. None means no request at all (worker threads, management commands).
+NOT_SAMPLED = object()
+
+_current_trace = contextvars.ContextVar('instrumentation_trace', default=None)
+
+class Trace:
+    """Timings collected while one sampled request is handled"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.spans = {}
+
+    def add_span(self, name, seconds):
+        self.spans[name] = self.spans.get(name, 0.0) + seconds
+
+    def elapsed(self):
+        return time.perf_counter() - self.started
+
+class Metrics:
+    """Process-wide histograms and counters, rendered in the Prometheus text format"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._histograms = defaultdict(dict)
+        self._counters = defaultdict(lambda: defaultdict(float))
+
+    def observe(self, name, labels, value):
+        with self._lock:
+            series = self._histograms[name].get(labels)
+            if series is None:
+                # One count per bucket, then the sum and the total count
+                series = self._histograms[name][labels] = [0] * len(DURATION_BUCKETS) + [0.0, 0]
+            for i, bound in enumerate(DURATION_BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def inc(self, name, labels, amount=1):
+        with self._lock:
+            self._counters[name][labels] += amount
+
+    def snapshot(self):
+        with self._lock:
+            histograms = {name: {labels: list(series) for labels, series in by_labels.items()}
+                          for name, by_labels in self._histograms.items()}
+            counters = {name: dict(by_labels) for name, by_labels in self._counters.items()}
+        return histograms, counters
+
+metrics = Metrics()
+
+METRIC_HELP = {
+    'procure_http_request_duration_seconds': 'Time from the request reaching Django to the response being returned',
+    'procure_db_queries_total': 'Database queries run by sampled requests',
+    'procure_db_query_duration_seconds_total': 'Time spent in database queries by sampled requests',
+    'procure_span_duration_seconds': 'Duration of instrumented stages (serialization, document processing)',
+    'procure_cache_hits_total': 'Cache lookups answered from the user or extraction cache',
+    'procure_cache_misses_total': 'Cache lookups that had to load or compute the value',
+}
+
+class span:
+    """Time a block as a named stage, e.g. `with span('document.text'):`.
+    Inside a sampled request it also appears in the Server-Timing header;
+    inside an unsampled one it costs a context variable lookup."""
+    __slots__ = ('name', 'started')
+
+    def __init__(self, name):
+        self.name = name
+        self.started = None
+
+    def __enter__(self):
+        if _current_trace.get() is not NOT_SAMPLED:
+            self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        if self.started is None:
+            return
+        elapsed = time.perf_counter() - self.started
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_span(self.name, elapsed)
+        metrics.observe('procure_span_duration_seconds', (('span', self.name),), elapsed)
+
+def timed(name):
+    """Decorator form of span()"""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def start_trace(force=False):
+    """Decide whether this request is sampled and make it the current trace.
+    Returns (trace or None, token for end_trace)."""
+    if force or random.random() < settings.INSTRUMENTATION_SAMPLE_RATE:
+        trace = Trace()
+        return trace, _current_trace.set(trace)
+    return None, _current_trace.set(NOT_SAMPLED)
+
+def end_trace(token):
+    _current_trace.reset(token)
+
+def record_request(trace, view_name, method, status_code):
+    elapsed = trace.elapsed()
+    view = (('view', view_name),)
+    metrics.observe(
+        'procure_http_request_duration_seconds',
+        (('view', view_name), ('method', method), ('status', str(status_code))),
+        elapsed,
+    )
+    metrics.inc('procure_db_queries_total', view, trace.queries)
+    metrics.inc('procure_db_query_duration_seconds_total', view, trace.db_seconds)
+    return elapsed
+
+def server_timing(trace, elapsed):
+    """Server-Timing header value: total, database and each span, in milliseconds"""
+    entries = [
+        f'app;dur={elapsed * 1000:.1f}',
+        f'db;dur={trace.db_seconds * 1000:.1f};desc="{trace.queries} queries"',
+    ]
+    entries.extend(f'{name};dur={seconds * 1000:.1f}' for name, seconds in trace.spans.items())
+    return ', '.join(entries)
+
+def _record_query(execute, sql, params, many, context):
+    trace = _current_trace.get()
+    if trace is None or trace is NOT_SAMPLED:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        trace.queries += 1
+        trace.db_seconds += time.perf_counter() - started
+
+@receiver(connection_created)
+def instrument_connection(sender, connection, **kwargs):
+    # Fires on every (re)connect of a connection object, so avoid stacking wrappers
+    if _record_query not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record_query)
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in labels) + '}'
+
+def _cache_counters():
+    """Hit/miss counters of this process's user and extraction caches"""
+    from .extraction_cache import get_extraction_cache
+    from .user_cache import get_user_cache
+
+    counters = {}
+    for cache_name, cache in (('user', get_user_cache()), ('extraction', get_extraction_cache())):
+        stats = cache.stats()
+        for outcome in ('hits', 'misses'):
+            counters.setdefault(f'procure_cache_{outcome}_total', {})[(('cache', cache_name),)] = stats[outcome]
+    return counters
+
+def render_metrics():
+    """All metrics of this process in the Prometheus text exposition format"""
+    histograms, counters = metrics.snapshot()
+    counters.update(_cache_counters())
+    lines = []
+    for name, by_labels in sorted(histograms.items()):
+        lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} histogram')
+        for labels, series in sorted(by_labels.items()):
+            for bound, count in zip(DURATION_BUCKETS, series):
+                lines.append(f'{name}_bucket{_format_labels(labels + (("le", bound),))} {count}')
+            lines.append(f'{name}_bucket{_format_labels(labels + (("le", "+Inf"),))} {series[-1]}')
+            lines.append(f'{name}_sum{_format_labels(labels)} {series[-2]}')
+            lines.append(f'{name}_count{_format_labels(labels)} {series[-1]}')
+    for name, by_labels in sorted(counters.items()):
+        lines.append(f'# HELP {name} {METRIC_HELP.get(name, name)}')
+        lines.append(f'# TYPE {name} counter')
+        for labels, value in sorted(by_labels.items()):
+            lines.append(f'{name}{_format_labels(labels)} {value}')
+    lines.append('# HELP procure_instrumentation_sample_rate Fraction of requests timed')
+    lines.append('# TYPE procure_instrumentation_sample_rate gauge')
+    lines.append(f'procure_instrumentation_sample_rate {settings.INSTRUMENTATION_SAMPLE_RATE}')
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,133 @@
+import random
+import re
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from api.document_processor import extract_fields
+
+VENDORS = ['Acme Supplies Ltd', 'Kigali Office Mart', 'Blue & Co.', 'Tech, Inc.', 'Great Lakes Trading']
+
+def synthetic_invoice(rng):
+    """Build the text of a proforma invoice in one of the layouts seen in uploads"""
+    vendor = rng.choice(VENDORS)
+    layout = rng.random()
+    if layout < 0.4:
+        lines = [vendor, 'Address: 12 KN 4 Ave, Kigali', 'Tel: +250 788 000 000']
+    elif layout < 0.8:
+        lines = ['PROFORMA INVOICE', f'Supplier: {vendor}']
+    else:
+        lines = [vendor]
+
+    if rng.random() < 0.7:
+        lines.append(f'Invoice No: PF-{rng.randint(1000, 9999)}')
+    else:
+        lines.append(f'Ref #{rng.randint(100, 999)}')
+
+    date_style = rng.random()
+    if date_style < 0.4:
+        lines.append(f'Date: {rng.randint(1, 12)}/{rng.randint(1, 28)}/2024')
+    elif date_style < 0.7:
+        lines.append(f'Date: {rng.choice(["Jan", "March", "Sept"])} {rng.randint(1, 28)}, 2024')
+    else:
+        lines.append(f'Issued {rng.randint(1, 28)}-{rng.randint(1, 12)}-24')
+
+    total = 0
+    for i in range(rng.randint(3, 40)):
+        quantity = rng.randint(1, 9)
+        unit_price = rng.randint(100, 99999) / 100
+        total += quantity * unit_price
+        lines.append(f'Item {i} description goes here {quantity} x {unit_price:.2f} {quantity * unit_price:.2f}')
+        if rng.random() < 0.1:
+            lines.append('Note: handle with care')
+
+    lines.append(rng.choice([
+        f'Total: ${total:,.2f}',
+        f'Grand Total: {total:.2f}',
+        f'Amount due ${total:,.2f}',
+        f'{total:.2f}',
+    ]))
+    lines.append('Thank you for your business. Payment within 30 days.')
+    return '\n'.join(lines)
+
+def legacy_extract_fields(text):
+    """The per-field implementation extract_fields replaced, kept as the reference"""
+    def first_group(patterns, group):
+        for pattern in patterns:
+            match = re.search(pattern, text, re.IGNORECASE)
+            if match:
+                return match.group(group)
+        return None
+
+    vendor = first_group([
+        r'(?:Vendor|Supplier|From|Company):\s*([A-Za-z\s&.,]+)',
+        r'([A-Z][A-Za-z\s&.,]+)\n.*(?:Address|Tel|Email)',
+    ], 1)
+    vendor = vendor.strip() if vendor is not None else text.split('\n')[0].strip()
+
+    items = []
+    for line in text.split('\n'):
+        if re.search(r'\d+\.\d{2}', line) and len(line.split()) > 2:
+            items.append(line.strip())
+
+    total_amount = None
+    for pattern in [r'(?:Total|Amount|Grand Total|Sum):\s*\$?\s*([\d,]+\.?\d*)', r'\$\s*([\d,]+\.\d{2})']:
+        match = re.search(pattern, text, re.IGNORECASE)
+        if match:
+            try:
+                total_amount = float(match.group(1).replace(',', ''))
+                break
+            except ValueError:
+                pass
+    if total_amount is None:
+        amounts = re.findall(r'\d+\.\d{2}', text)
+        total_amount = float(amounts[-1]) if amounts else 0.0
+
+    date = first_group([
+        r'\d{1,2}/\d{1,2}/\d{2,4}',
+        r'\d{1,2}-\d{1,2}-\d{2,4}',
+        r'(?:Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec)[a-z]*\s+\d{1,2},?\s+\d{4}',
+    ], 0)
+    invoice_number = first_group([
+        r'(?:Invoice|Proforma|Ref|No|Number)[\s#:]*([A-Z0-9-]+)',
+        r'#([A-Z0-9-]+)',
+    ], 1)
+
+    return {
+        'vendor': vendor,
+        'items': items[:10] if items else ["Item details not extracted"],
+        'total_amount': total_amount,
+        'date': date or "Date not found",
+        'invoice_number': invoice_number or "N/A",
+    }
+
+class Command(BaseCommand):
+    help = 'Compare field extraction throughput against the legacy per-field regex scans'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--documents', type=int, default=2000)
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Timed runs per implementation; the best run is reported')
+        parser.add_argument('--seed', type=int, default=42)
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        corpus = [synthetic_invoice(rng) for _ in range(options['documents'])]
+
+        mismatches = sum(1 for text in corpus if extract_fields(text) != legacy_extract_fields(text))
+        if mismatches:
+            raise CommandError(f'{mismatches} document(s) extracted differently from the legacy implementation')
+
+        results = {}
+        for name, extract in [('legacy', legacy_extract_fields), ('engine', extract_fields)]:
+            best = None
+            for _ in range(options['repeat']):
+                started = time.perf_counter()
+                for text in corpus:
+                    extract(text)
+                elapsed = time.perf_counter() - started
+                best = elapsed if best is None else min(best, elapsed)
+            results[name] = len(corpus) / best
+            self.stdout.write(f'{name:>6}: {results[name]:,.0f} documents/s')
+
+        self.stdout.write(f'speedup: {results["engine"] / results["legacy"]:.2f}x over {len(corpus)} documents')
@@ -0,0 +1,406 @@
+import http.client
+import json
+import random
+import subprocess
+import threading
+import time
+import uuid
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone as dt_timezone
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from django.contrib.auth.hashers import make_password
+from django.core.management.base import BaseCommand, CommandError
+
+from api.analytics import rebuild_spend_rollups
+from api.models import ApprovalStep, PurchaseRequest, User
+from api.workflow import activate, levels_for
+
+VENDORS = ['Acme Supplies Ltd', 'Kigali Office Mart', 'Blue & Co.', 'Tech, Inc.', 'Great Lakes Trading']
+PRODUCTS = ['Office chair', 'Desk lamp', 'Printer paper box', 'Laptop stand', 'Whiteboard', 'Toner cartridge']
+PASSWORD = 'benchmark-password'
+PERCENTILES = (50, 90, 95, 99)
+LINES_PER_PAGE = 50
+
+def pdf_document(lines):
+    """A minimal text PDF (Helvetica, one line per row), enough for pdfplumber to read back"""
+    pages = [lines[i:i + LINES_PER_PAGE] for i in range(0, len(lines), LINES_PER_PAGE)] or [[]]
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        ('<< /Type /Pages /Kids [%s] /Count %d >>' % (
+            ' '.join(f'{4 + 2 * i} 0 R' for i in range(len(pages))), len(pages)
+        )).encode(),
+        b'<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>',
+    ]
+    for i, page in enumerate(pages):
+        text = ['BT /F1 11 Tf 50 780 Td 14 TL']
+        for line in page:
+            escaped = line.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+            text.append(f'({escaped}) Tj T*')
+        text.append('ET')
+        stream = '\n'.join(text).encode('latin-1', 'replace')
+        objects.append((
+            '<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] '
+            f'/Resources << /Font << /F1 3 0 R >> >> /Contents {5 + 2 * i} 0 R >>'
+        ).encode())
+        objects.append(b'<< /Length %d >>\nstream\n%s\nendstream' % (len(stream), stream))
+
+    out = b'%PDF-1.4\n'
+    offsets = []
+    for number, body in enumerate(objects, 1):
+        offsets.append(len(out))
+        out += b'%d 0 obj\n%s\nendobj\n' % (number, body)
+    xref = len(out)
+    out += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    out += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    out += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref)
+    return out
+
+def seeded_steps(purchase_request):
+    """Approval steps matching a seeded request's status"""
+    steps = [
+        ApprovalStep(purchase_request=purchase_request, level=level, role=role)
+        for level, role in levels_for(purchase_request.amount)
+    ]
+    if purchase_request.status == 'pending':
+        for step, status in activate(steps):
+            step.status = status
+    else:
+        for step in steps:
+            step.status = 'approved' if purchase_request.status == 'approved' else 'cancelled'
+        if purchase_request.status == 'rejected':
+            steps[0].status = 'rejected'
+    return steps
+
+def synthetic_purchase(rng, index):
+    """Proforma and matching receipt PDFs for one request; every tenth receipt
+    is short by one line so validation also exercises its discrepancy path"""
+    vendor = rng.choice(VENDORS)
+    items = []
+    total = Decimal('0')
+    for product in rng.sample(PRODUCTS, rng.randint(1, 4)):
+        quantity = rng.randint(1, 9)
+        unit_price = Decimal(rng.randint(500, 50000)) / 100
+        total += quantity * unit_price
+        items.append(f'{product} {quantity} x {unit_price:.2f} {quantity * unit_price:.2f}')
+
+    proforma = [f'Supplier: {vendor}', f'Invoice No: PF-{index:05d}', 'Date: 3/14/2024', *items, f'Total: {total:.2f}']
+    receipt_items = items[:-1] if index % 10 == 9 and len(items) > 1 else items
+    receipt = [f'Vendor: {vendor}', f'Receipt No: RC-{index:05d}', *receipt_items, f'Total: {total:.2f}']
+    return {
+        'title': f'Benchmark purchase {index}',
+        'description': f'{len(items)} item(s) from {vendor}',
+        'amount': f'{total:.2f}',
+        'proforma': pdf_document(proforma),
+        'receipt': pdf_document(receipt),
+    }
+
+def encode_multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (file_name, content) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{file_name}"\r\n'
+            'Content-Type: application/pdf\r\n\r\n'.encode() + content + b'\r\n'
+        )
+    parts.append(f'--{boundary}--\r\n'.encode())
+    return b''.join(parts), f'multipart/form-data; boundary={boundary}'
+
+def percentile(sorted_values, p):
+    """Nearest-rank percentile of an already sorted list"""
+    if not sorted_values:
+        return None
+    rank = max(int(round(p / 100 * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+class Recorder:
+    """Thread-safe collection of (seconds, status, queries) samples per workflow step"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.samples = defaultdict(list)
+
+    def record(self, step, seconds, status, queries):
+        with self._lock:
+            self.samples[step].append((seconds, status, queries))
+
+    def summary(self):
+        steps = {}
+        for step, samples in sorted(self.samples.items()):
+            latencies = sorted(seconds * 1000 for seconds, _, _ in samples)
+            queries = [count for _, _, count in samples if count is not None]
+            steps[step] = {
+                'count': len(samples),
+                'errors': sum(1 for _, status, _ in samples if status >= 400),
+                'latency_ms': {
+                    'mean': round(sum(latencies) / len(latencies), 2),
+                    **{f'p{p}': round(percentile(latencies, p), 2) for p in PERCENTILES},
+                    'max': round(latencies[-1], 2),
+                },
+                'queries': {
+                    'mean': round(sum(queries) / len(queries), 2),
+                    'max': max(queries),
+                } if queries else None,
+            }
+        return steps
+
+class ApiClient:
+    """One keep-alive HTTP connection per thread to the server under test"""
+
+    def __init__(self, base_url, recorder, timeout):
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.netloc = url.netloc
+        self.prefix = url.path.rstrip('/')
+        self.recorder = recorder
+        self.timeout = timeout
+        self._local = threading.local()
+
+    def _connection(self):
+        if getattr(self._local, 'connection', None) is None:
+            self._local.connection = self.connection_class(self.netloc, timeout=self.timeout)
+        return self._local.connection
+
+    def call(self, step, method, path, token=None, data=None, fields=None, files=None):
+        headers = {'Accept': 'application/json'}
+        if token:
+            headers['Authorization'] = f'Bearer {token}'
+        body = None
+        if files is not None:
+            body, headers['Content-Type'] = encode_multipart(fields or {}, files)
+        elif data is not None:
+            body = json.dumps(data).encode()
+            headers['Content-Type'] = 'application/json'
+
+        started = time.perf_counter()
+        for attempt in range(2):
+            connection = self._connection()
+            try:
+                connection.request(method, self.prefix + path, body=body, headers=headers)
+                response = connection.getresponse()
+                payload = response.read()
+                break
+            except (http.client.HTTPException, ConnectionError):
+                # The server closed an idle keep-alive connection; reconnect once
+                connection.close()
+                self._local.connection = None
+                if attempt:
+                    raise
+        elapsed = time.perf_counter() - started
+
+        queries = response.getheader('X-Query-Count')
+        self.recorder.record(step, elapsed, response.status, int(queries) if queries is not None else None)
+        try:
+            return response.status, json.loads(payload) if payload else None
+        except ValueError:
+            return response.status, None
+
+class Command(BaseCommand):
+    help = ('Seed users and requests, then drive create -> level 1 approve -> level 2 approve '
+            '-> submit receipt concurrently against a running server and report latency, '
+            'queries per request and documents per second')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--url', default='http://127.0.0.1:8000')
+        parser.add_argument('--users', type=int, default=20,
+                            help='Users to create, spread evenly over the four roles')
+        parser.add_argument('--requests', type=int, default=100, help='Workflows to run')
+        parser.add_argument('--background-requests', type=int, default=0,
+                            help='Extra requests inserted directly beforehand, to benchmark against a larger table')
+        parser.add_argument('--concurrency', type=int, default=8)
+        parser.add_argument('--seed', type=int, default=42)
+        parser.add_argument('--document-timeout', type=float, default=60,
+                            help='Seconds to wait for proforma extraction and PO generation per request')
+        parser.add_argument('--poll-interval', type=float, default=0.25)
+        parser.add_argument('--timeout', type=float, default=60, help='HTTP timeout in seconds')
+        parser.add_argument('--output', help='Write the results as JSON to this file ("-" for stdout)')
+        parser.add_argument('--compare', help='Results file of an earlier run to print p95 changes against')
+        parser.add_argument('--keep-data', action='store_true',
+                            help='Leave the benchmark users and their requests in the database')
+
+    def handle(self, *args, **options):
+        rng = random.Random(options['seed'])
+        run_id = uuid.uuid4().hex[:8]
+        roles = [role for role, _ in User.ROLE_CHOICES]
+        if options['users'] < len(roles):
+            raise CommandError(f'--users must be at least {len(roles)}, one per role')
+
+        self.stdout.write(f'Seeding run {run_id}: {options["users"]} user(s), '
+                          f'{options["background_requests"]} background request(s)')
+        users = self.seed(run_id, roles, options, rng)
+        purchases = [synthetic_purchase(rng, i) for i in range(options['requests'])]
+
+        recorder = Recorder()
+        client = ApiClient(options['url'], recorder, options['timeout'])
+        try:
+            tokens = self.login(client, users)
+            self.stdout.write(f'Running {len(purchases)} workflow(s) with concurrency {options["concurrency"]}')
+            started = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=options['concurrency']) as pool:
+                outcomes = list(pool.map(
+                    lambda args: self.run_workflow(client, tokens, options, *args), enumerate(purchases)
+                ))
+            wall = time.perf_counter() - started
+        finally:
+            if not options['keep_data']:
+                # Cascades to their requests, jobs, uploads and spend rollups
+                User.objects.filter(username__startswith=f'bench-{run_id}-').delete()
+
+        results = self.results(run_id, options, recorder, outcomes, wall)
+        self.report(results, options.get('compare'))
+        if options['output'] == '-':
+            self.stdout.write(json.dumps(results, indent=2))
+        elif options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2)
+            self.stdout.write(f'Results written to {options["output"]}')
+
+    def seed(self, run_id, roles, options, rng):
+        password = make_password(PASSWORD)
+        users = User.objects.bulk_create([
+            User(username=f'bench-{run_id}-{roles[i % len(roles)]}-{i}', role=roles[i % len(roles)], password=password)
+            for i in range(options['users'])
+        ])
+        by_role = defaultdict(list)
+        for user in users:
+            by_role[user.role].append(user)
+
+        if options['background_requests']:
+            statuses = ['pending', 'approved', 'rejected']
+            seeded = PurchaseRequest.objects.bulk_create([
+                PurchaseRequest(
+                    title=f'Background request {i}', description='Seeded by benchmark_workflow',
+                    amount=Decimal(rng.randint(1000, 500000)) / 100,
+                    created_by=rng.choice(by_role['staff']), status=rng.choice(statuses),
+                    proforma_data={'vendor': rng.choice(VENDORS)}, extraction_status='done',
+                )
+                for i in range(options['background_requests'])
+            ], batch_size=1000)
+            ApprovalStep.objects.bulk_create([
+                step for purchase_request in seeded for step in seeded_steps(purchase_request)
+            ], batch_size=1000)
+            # bulk_create bypasses the incremental rollup updates
+            rebuild_spend_rollups()
+        return by_role
+
+    def login(self, client, users):
+        tokens = {}
+        for role, role_users in users.items():
+            tokens[role] = []
+            for user in role_users:
+                status, body = client.call('login', 'POST', '/api/auth/login/',
+                                           data={'username': user.username, 'password': PASSWORD})
+                if status != 200:
+                    raise CommandError(f'Login as {user.username} failed with {status}: {body}')
+                tokens[role].append(body['access'])
+        return tokens
+
+    def run_workflow(self, client, tokens, options, index, purchase):
+        """One request through the whole flow; returns what it achieved"""
+        outcome = {'completed': False, 'proforma_extracted': False, 'receipt_validated': False}
+
+        def token(role):
+            return tokens[role][index % len(tokens[role])]
+
+        status, body = client.call(
+            'create', 'POST', '/api/async/requests/', token('staff'),
+            fields={key: purchase[key] for key in ('title', 'description', 'amount')},
+            files={'proforma': (f'proforma-{index}.pdf', purchase['proforma'])},
+        )
+        if status != 201:
+            return outcome
+        pk = body['id']
+
+        # One approval per level the workflow routed the request through
+        for step in body['approval_steps']:
+            status, _ = client.call(
+                f"approve_level_{step['level']}", 'PATCH', f'/api/requests/{pk}/approve/', token(step['role']), data={}
+            )
+            if status != 200:
+                return outcome
+
+        # Extraction and PO generation happen in the document worker
+        started = time.perf_counter()
+        deadline = started + options['document_timeout']
+        while True:
+            status, body = client.call('poll_detail', 'GET', f'/api/requests/{pk}/', token('staff'))
+            ready = status == 200 and body['purchase_order_data'] and body['extraction_status'] in ('done', 'failed')
+            if ready or time.perf_counter() > deadline:
+                break
+            time.sleep(options['poll_interval'])
+        client.recorder.record('documents_ready', time.perf_counter() - started, 200 if ready else 504, None)
+        outcome['proforma_extracted'] = status == 200 and body['extraction_status'] == 'done'
+
+        status, body = client.call(
+            'submit_receipt', 'POST', f'/api/async/requests/{pk}/submit_receipt/', token('staff'),
+            files={'receipt': (f'receipt-{index}.pdf', purchase['receipt'])},
+        )
+        if status != 200:
+            return outcome
+        validation = body.get('validation') or {}
+        outcome['receipt_validated'] = 'is_valid' in validation and 'error' not in validation
+
+        client.call('finance_list', 'GET', '/api/requests/?compact=true', token('finance'))
+        outcome['completed'] = True
+        return outcome
+
+    def results(self, run_id, options, recorder, outcomes, wall):
+        steps = recorder.summary()
+        documents = sum(outcome['proforma_extracted'] + outcome['receipt_validated'] for outcome in outcomes)
+        api_calls = sum(step['count'] for name, step in steps.items() if name != 'documents_ready')
+        try:
+            commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True, check=True).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            commit = None
+        return {
+            'benchmark': 'workflow',
+            'run_id': run_id,
+            'commit': commit,
+            'finished_at': datetime.now(dt_timezone.utc).isoformat(),
+            'options': {key: options[key] for key in (
+                'url', 'users', 'requests', 'background_requests', 'concurrency', 'seed'
+            )},
+            'wall_seconds': round(wall, 3),
+            'workflows': {
+                'completed': sum(outcome['completed'] for outcome in outcomes),
+                'failed': sum(not outcome['completed'] for outcome in outcomes),
+            },
+            'documents': {
+                'proformas_extracted': sum(outcome['proforma_extracted'] for outcome in outcomes),
+                'receipts_validated': sum(outcome['receipt_validated'] for outcome in outcomes),
+            },
+            'throughput': {
+                'workflows_per_second': round(len(outcomes) / wall, 3),
+                'api_calls_per_second': round(api_calls / wall, 3),
+                'documents_per_second': round(documents / wall, 3),
+            },
+            'steps': steps,
+        }
+
+    def report(self, results, compare_path):
+        baseline = {}
+        if compare_path:
+            with open(compare_path) as f:
+                baseline = json.load(f).get('steps', {})
+
+        self.stdout.write(f"{'step':<16}{'count':>7}{'errors':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'queries':>9}")
+        for name, step in results['steps'].items():
+            latency = step['latency_ms']
+            queries = f"{step['queries']['mean']:.1f}" if step['queries'] else '-'
+            line = (f"{name:<16}{step['count']:>7}{step['errors']:>8}{latency['p50']:>10.1f}"
+                    f"{latency['p95']:>10.1f}{latency['p99']:>10.1f}{queries:>9}")
+            before = baseline.get(name, {}).get('latency_ms', {}).get('p95')
+            if before:
+                line += f"  p95 {(latency['p95'] - before) / before:+.0%}"
+            self.stdout.write(line)
+
+        throughput = results['throughput']
+        self.stdout.write(
+            f"{results['workflows']['completed']} workflow(s) completed, {results['workflows']['failed']} failed "
+            f"in {results['wall_seconds']:.1f}s: {throughput['workflows_per_second']:.2f} workflows/s, "
+            f"{throughput['api_calls_per_second']:.1f} calls/s, {throughput['documents_per_second']:.2f} documents/s"
+        )
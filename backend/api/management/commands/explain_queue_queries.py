@@ -0,0 +1,39 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from api.models import User, PurchaseRequest
+
+class Command(BaseCommand):
+    help = 'Show the query plan of each role-based request queue'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--database', default='default')
+        parser.add_argument('--page-size', type=int, default=50,
+                            help='Rows per dashboard page; 0 explains the unsliced queue')
+        parser.add_argument('--analyze', action='store_true',
+                            help='Run EXPLAIN ANALYZE (PostgreSQL only; executes the queries)')
+
+    def handle(self, *args, **options):
+        database = options['database']
+        vendor = connections[database].vendor
+        explain_options = {}
+        if options['analyze']:
+            if vendor != 'postgresql':
+                raise CommandError('--analyze is only supported on PostgreSQL')
+            explain_options = {'analyze': True, 'buffers': True}
+
+        staff = User.objects.using(database).filter(role='staff').order_by('pk').first()
+        if staff is None:
+            # Plans only depend on the shape of the filter, not on the user.
+            staff = User(pk=0, role='staff')
+
+        self.stdout.write(f'Query plans on {vendor} ({database})')
+        for role, _ in User.ROLE_CHOICES:
+            user = staff if role == 'staff' else User(role=role)
+            queryset = PurchaseRequest.objects.using(database).visible_to(user)
+            if options['page_size']:
+                queryset = queryset[:options['page_size']]
+
+            self.stdout.write(f'\n== {role} ==')
+            self.stdout.write(str(queryset.query))
+            self.stdout.write(queryset.explain(**explain_options))
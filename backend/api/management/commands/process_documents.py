@@ -0,0 +1,90 @@
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from io import BytesIO
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.document_processor import extract_proforma_data
+from api.tasks import (
+    claim_jobs, complete_job, fail_job, generate_purchase_orders, job_source, requeue_stale_jobs
+)
+
+EXTRACTORS = {
+    'proforma': extract_proforma_data,
+}
+
+def run_extraction(kind, source):
+    """Runs inside a pool process; only touches the file, never the database"""
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    return EXTRACTORS[kind](source)
+
+class Command(BaseCommand):
+    help = 'Process queued document extraction jobs on a process pool'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=settings.DOCUMENT_WORKER_PROCESSES)
+        parser.add_argument('--poll-interval', type=float, default=2.0)
+        parser.add_argument('--stale-after', type=int, default=600,
+                            help='Seconds after which a running job is assumed lost and requeued')
+        parser.add_argument('--once', action='store_true',
+                            help='Drain the queue and exit instead of polling')
+
+    def handle(self, *args, **options):
+        workers = options['workers']
+        requeued = requeue_stale_jobs(options['stale_after'])
+        if requeued:
+            self.stdout.write(f'Requeued {requeued} stale job(s)')
+
+        self.stdout.write(f'Processing document jobs with {workers} worker(s)')
+        in_flight = {}
+
+        # Spawned children set up Django themselves and open their own
+        # database connections (the extraction cache may use the database).
+        pool = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+        with pool:
+            while True:
+                # Purchase orders only need the database and a template, so
+                # they are generated here in batches rather than in the pool.
+                po_jobs = claim_jobs(settings.PURCHASE_ORDER_BATCH_SIZE, kind='purchase_order')
+                if po_jobs:
+                    generated = generate_purchase_orders(po_jobs)
+                    self.stdout.write(f'Generated {len(generated)} purchase order(s)')
+
+                free = workers - len(in_flight)
+                if free > 0:
+                    for job in claim_jobs(free):
+                        try:
+                            source = job_source(job)
+                        except Exception as e:
+                            fail_job(job, e)
+                            continue
+                        future = pool.submit(run_extraction, job.kind, source)
+                        in_flight[future] = job
+
+                if not in_flight:
+                    if po_jobs:
+                        continue
+                    if options['once']:
+                        break
+                    time.sleep(options['poll_interval'])
+                    continue
+
+                done, _ = wait(in_flight, timeout=options['poll_interval'], return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = in_flight.pop(future)
+                    try:
+                        data = future.result()
+                    except Exception as e:
+                        fail_job(job, e)
+                        self.stderr.write(f'Job {job.pk} failed: {e}')
+                    else:
+                        complete_job(job, data)
+                        self.stdout.write(f'Job {job.pk} done')
@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from api.uploads import purge_stale_uploads
+
+class Command(BaseCommand):
+    help = 'Delete chunked uploads that were abandoned before being attached to a request'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--max-age', type=int, default=settings.UPLOAD_EXPIRY_SECONDS,
+                            help='Seconds since the last chunk after which an upload is discarded')
+
+    def handle(self, *args, **options):
+        purged = purge_stale_uploads(options['max_age'])
+        self.stdout.write(f'Purged {purged} stale upload(s)')
@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from api.analytics import rebuild_spend_rollups
+
+class Command(BaseCommand):
+    help = 'Recompute the spend rollup table from all purchase requests'
+
+    def handle(self, *args, **options):
+        buckets = rebuild_spend_rollups()
+        self.stdout.write(f'Rebuilt {buckets} spend bucket(s)')
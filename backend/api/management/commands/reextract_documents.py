@@ -0,0 +1,139 @@
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import django
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db.models import Q
+
+from api.document_processor import EXTRACTOR_VERSION
+from api.models import PurchaseRequest
+from api.tasks import file_source, reextract_source, store_reextracted
+
+KINDS = ('proforma', 'receipt')
+
+def affected_requests(kinds):
+    """Requests holding a stored document of one of `kinds` that extraction can be re-run on"""
+    condition = Q()
+    if 'proforma' in kinds:
+        condition |= ~Q(proforma='') & Q(proforma__isnull=False)
+    if 'receipt' in kinds:
+        # Receipts are only validated against a generated purchase order
+        condition |= ~Q(receipt='') & Q(receipt__isnull=False) & Q(purchase_order_data__isnull=False)
+    return PurchaseRequest.objects.filter(condition).order_by('pk')
+
+class Command(BaseCommand):
+    help = ('Re-run extraction for stored proformas and receipt validation after the '
+            'extraction rules change, resuming from a checkpoint if interrupted')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--kind', choices=KINDS, action='append',
+                            help='Document kind to reprocess; repeat for both (default: both)')
+        parser.add_argument('--workers', type=int, default=settings.DOCUMENT_WORKER_PROCESSES)
+        parser.add_argument('--chunk-size', type=int, default=100,
+                            help='Requests read, extracted and written back per transaction')
+        parser.add_argument('--pause', type=float, default=1.0,
+                            help='Seconds to sleep after writing each chunk, to leave room for live traffic')
+        parser.add_argument('--checkpoint', default=str(settings.BASE_DIR / 'reextract_documents.checkpoint'),
+                            help='File recording progress; a rerun with the same options resumes from it')
+        parser.add_argument('--restart', action='store_true',
+                            help='Ignore an existing checkpoint and start from the first request')
+
+    def handle(self, *args, **options):
+        kinds = tuple(sorted(set(options['kind'] or KINDS)))
+        checkpoint_path = options['checkpoint']
+        checkpoint = None if options['restart'] else self.load_checkpoint(checkpoint_path, kinds)
+        if checkpoint is None:
+            checkpoint = {'extractor_version': EXTRACTOR_VERSION, 'kinds': list(kinds),
+                          'last_pk': 0, 'updated': 0, 'failed': 0}
+        else:
+            self.stdout.write(f"Resuming after request {checkpoint['last_pk']}")
+
+        queryset = affected_requests(kinds)
+        remaining = queryset.filter(pk__gt=checkpoint['last_pk']).count()
+        self.stdout.write(f'Reprocessing {", ".join(kinds)} documents of {remaining} request(s) '
+                          f'with {options["workers"]} worker(s)')
+
+        # Spawned children set up Django themselves and open their own
+        # database connections (the extraction cache may use the database).
+        pool = ProcessPoolExecutor(
+            max_workers=options['workers'],
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+        done = 0
+        started = time.perf_counter()
+        with pool:
+            while True:
+                rows = list(
+                    queryset.filter(pk__gt=checkpoint['last_pk'])
+                    .values('pk', 'proforma', 'receipt', 'purchase_order_data')[:options['chunk_size']]
+                )
+                if not rows:
+                    break
+
+                results, failed = self.extract_chunk(pool, rows, kinds)
+                checkpoint['updated'] += store_reextracted(results)
+                checkpoint['failed'] += failed
+                checkpoint['last_pk'] = rows[-1]['pk']
+                self.save_checkpoint(checkpoint_path, checkpoint)
+
+                done += len(rows)
+                self.stdout.write(
+                    f"{done}/{remaining} request(s), {checkpoint['updated']} updated, "
+                    f"{checkpoint['failed']} failed, {time.perf_counter() - started:.1f}s"
+                )
+                if options['pause']:
+                    time.sleep(options['pause'])
+
+        if os.path.exists(checkpoint_path):
+            os.remove(checkpoint_path)
+        self.stdout.write(f"Done: {checkpoint['updated']} request(s) updated, {checkpoint['failed']} document(s) failed")
+
+    def extract_chunk(self, pool, rows, kinds):
+        futures = {}
+        failed = 0
+        for row in rows:
+            for kind in kinds:
+                file_name = row[kind]
+                if not file_name or (kind == 'receipt' and not row['purchase_order_data']):
+                    continue
+                try:
+                    source = file_source(kind, file_name)
+                except Exception as e:
+                    self.stderr.write(f"Request {row['pk']} {kind}: {e}")
+                    failed += 1
+                    continue
+                future = pool.submit(reextract_source, kind, source, row['purchase_order_data'])
+                futures[future] = (row['pk'], kind, file_name)
+
+        results = []
+        for future in as_completed(futures):
+            pk, kind, file_name = futures[future]
+            try:
+                results.append((pk, kind, file_name, future.result()))
+            except Exception as e:
+                self.stderr.write(f'Request {pk} {kind}: {e}')
+                failed += 1
+        return results, failed
+
+    def load_checkpoint(self, path, kinds):
+        try:
+            with open(path) as f:
+                checkpoint = json.load(f)
+        except FileNotFoundError:
+            return None
+        if checkpoint.get('extractor_version') != EXTRACTOR_VERSION or tuple(checkpoint.get('kinds', ())) != kinds:
+            # Progress made under other rules or for other documents does not carry over
+            self.stdout.write('Ignoring checkpoint from a run with different rules or kinds')
+            return None
+        return checkpoint
+
+    def save_checkpoint(self, path, checkpoint):
+        # Write then rename, so an interrupted write never leaves a torn file
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(checkpoint, f)
+        os.replace(f'{path}.tmp', path)
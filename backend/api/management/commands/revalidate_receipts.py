@@ -0,0 +1,33 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from api.matching import build_vendor_index, revalidate_receipts
+
+class Command(BaseCommand):
+    help = 'Re-run receipt to purchase order matching from stored receipt data, without opening the documents'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500)
+        parser.add_argument('--force', action='store_true',
+                            help='Also recheck receipts already matched by the current rules')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would change without saving')
+
+    def handle(self, *args, **options):
+        started = time.perf_counter()
+        index = build_vendor_index()
+        self.stdout.write(f'Indexed {len(index)} vendor(s)')
+
+        counts = revalidate_receipts(
+            batch_size=options['batch_size'],
+            force=options['force'],
+            dry_run=options['dry_run'],
+            vendor_index=index,
+        )
+        elapsed = time.perf_counter() - started
+        verb = 'Would update' if options['dry_run'] else 'Updated'
+        self.stdout.write(
+            f"Checked {counts['checked']} receipt(s) in {elapsed:.2f}s; {verb} {counts['changed']}, "
+            f"skipped {counts['skipped']} without stored receipt data"
+        )
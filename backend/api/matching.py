@@ -0,0 +1,341 @@
+import re
+import threading
+import time
+import unicodedata
+from collections import defaultdict
+from decimal import Decimal, InvalidOperation
+from difflib import SequenceMatcher
+from functools import lru_cache
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import PurchaseRequest
+
+# Bump whenever matching rules change, so revalidate_receipts picks up
+# receipts that were checked under the previous rules.
+MATCHER_VERSION = '2'
+
+VENDOR_MATCH_THRESHOLD = 0.85
+LINE_MATCH_THRESHOLD = 0.6
+AMOUNT_TOLERANCE = Decimal('0.01')
+
+# Trailing words that only say what kind of company it is
+LEGAL_SUFFIXES = frozenset({
+    'co', 'company', 'corp', 'corporation', 'inc', 'incorporated', 'limited', 'llc',
+    'ltd', 'plc', 'gmbh', 'sarl', 'sa', 'bv', 'pty',
+})
+# Placeholders written by extraction and PO generation when no vendor was found
+UNKNOWN_VENDORS = frozenset({'unknown', 'n a'})
+
+TOKEN_PATTERN = re.compile(r'[a-z0-9]+')
+LINE_AMOUNT_PATTERN = re.compile(r'\d[\d,]*\.\d{2}')
+QUANTITY_PATTERN = re.compile(r'(?<![\d.,])(\d{1,5})(?:\s*(?:x|pcs|units?)\b|\s+@)', re.IGNORECASE)
+
+def _ascii_tokens(text):
+    text = unicodedata.normalize('NFKD', text).encode('ascii', 'ignore').decode()
+    return TOKEN_PATTERN.findall(text.lower().replace('&', ' and '))
+
+def vendor_key(name):
+    """Normalized vendor name: lowercase ASCII words without punctuation or legal suffixes"""
+    if not isinstance(name, str):
+        return ''
+    tokens = _ascii_tokens(name)
+    if tokens and tokens[0] == 'the':
+        tokens = tokens[1:]
+    while len(tokens) > 1 and (tokens[-1] in LEGAL_SUFFIXES or tokens[-1] == 'and'):
+        # "& Co" leaves a dangling "and" once "co" is dropped
+        tokens.pop()
+    key = ' '.join(tokens)
+    return '' if key in UNKNOWN_VENDORS else key
+
+def similarity(a, b):
+    if a == b:
+        return 1.0
+    return SequenceMatcher(None, a, b).ratio()
+
+class VendorIndex:
+    """Known vendor names keyed by vendor_key(), with a word-prefix index so a
+    misspelt name is only compared against vendors sharing a word prefix"""
+
+    def __init__(self, names=()):
+        self.names = {}
+        self._by_prefix = defaultdict(set)
+        self.resolve = lru_cache(maxsize=4096)(self._resolve)
+        for name in names:
+            self.add(name)
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name):
+        key = vendor_key(name)
+        if not key or key in self.names:
+            return
+        self.names[key] = name.strip()
+        for token in key.split():
+            self._by_prefix[token[:3]].add(key)
+        self.resolve.cache_clear()
+
+    def _resolve(self, key):
+        """Key of the known vendor closest to `key`, or None if none is close enough"""
+        if not key or key in self.names:
+            return key or None
+        candidates = set()
+        for token in key.split():
+            candidates.update(self._by_prefix.get(token[:3], ()))
+
+        best, best_score = None, VENDOR_MATCH_THRESHOLD
+        for candidate in candidates:
+            matcher = SequenceMatcher(None, key, candidate)
+            if matcher.real_quick_ratio() < best_score or matcher.quick_ratio() < best_score:
+                continue
+            score = matcher.ratio()
+            if score >= best_score:
+                best, best_score = candidate, score
+        return best
+
+def build_vendor_index():
+    """Index every vendor named in stored proforma and purchase order data"""
+    index = VendorIndex()
+    rows = PurchaseRequest.objects.filter(
+        Q(proforma_data__isnull=False) | Q(purchase_order_data__isnull=False)
+    ).values_list('proforma_data__vendor', 'purchase_order_data__vendor')
+    for names in rows.iterator(chunk_size=2000):
+        for name in names:
+            index.add(name)
+    return index
+
+_index = None
+_index_built_at = 0
+_index_rebuilding = False
+_index_lock = threading.Lock()
+
+def _rebuild_vendor_index():
+    global _index, _index_built_at, _index_rebuilding
+    try:
+        index = build_vendor_index()
+        with _index_lock:
+            _index, _index_built_at = index, time.monotonic()
+    finally:
+        with _index_lock:
+            _index_rebuilding = False
+        connection.close()
+
+def get_vendor_index():
+    """Return this process's vendor index. Only the first call waits for a build;
+    once the index is VENDOR_INDEX_TTL seconds old it is rebuilt on a background
+    thread, and callers get the previous index until that finishes."""
+    global _index, _index_built_at, _index_rebuilding
+    with _index_lock:
+        if _index is None:
+            _index = build_vendor_index()
+            _index_built_at = time.monotonic()
+        elif not _index_rebuilding and time.monotonic() - _index_built_at > settings.VENDOR_INDEX_TTL:
+            _index_rebuilding = True
+            threading.Thread(target=_rebuild_vendor_index, name='vendor-index', daemon=True).start()
+        return _index
+
+def match_vendor(po_vendor, receipt_vendor, index=None):
+    po_key, receipt_key = vendor_key(po_vendor), vendor_key(receipt_vendor)
+    result = {'po': po_vendor, 'receipt': receipt_vendor, 'matched': False, 'score': 0.0}
+    if not po_key or not receipt_key:
+        return result
+
+    score = similarity(po_key, receipt_key)
+    po_words, receipt_words = set(po_key.split()), set(receipt_key.split())
+    if po_words <= receipt_words or receipt_words <= po_words:
+        # "Acme" on the receipt for "Acme Office Supplies" on the PO
+        score = max(score, VENDOR_MATCH_THRESHOLD)
+    if index is not None and score < VENDOR_MATCH_THRESHOLD:
+        # Both spellings resolve to the same vendor seen on earlier requests
+        resolved = index.resolve(po_key)
+        if resolved and resolved == index.resolve(receipt_key):
+            score = max(score, similarity(receipt_key, resolved))
+            result['resolved'] = index.names[resolved]
+
+    result['score'] = round(score, 3)
+    result['matched'] = score >= VENDOR_MATCH_THRESHOLD
+    return result
+
+def to_decimal(value):
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        return Decimal(str(value).replace(',', '')).quantize(AMOUNT_TOLERANCE)
+    except (InvalidOperation, ValueError):
+        return None
+
+def parse_line_item(line):
+    """Description words, quantity and line total of an extracted item line,
+    or None for a line without an amount (such as the 'not extracted' placeholder)"""
+    if not isinstance(line, str):
+        return None
+    amounts = LINE_AMOUNT_PATTERN.findall(line)
+    if not amounts:
+        return None
+    quantity = QUANTITY_PATTERN.search(line)
+    description = LINE_AMOUNT_PATTERN.sub(' ', line)
+    if quantity:
+        description = description.replace(quantity.group(0), ' ', 1)
+    return {
+        'text': line.strip(),
+        'key': ' '.join(token for token in _ascii_tokens(description) if not token.isdigit()),
+        'quantity': int(quantity.group(1)) if quantity else None,
+        'amount': to_decimal(amounts[-1]),
+    }
+
+def _parse_items(items):
+    if not isinstance(items, list):
+        return []
+    return [item for item in map(parse_line_item, items) if item is not None]
+
+def _line_score(po_item, receipt_item):
+    score = similarity(po_item['key'], receipt_item['key'])
+    if po_item['amount'] == receipt_item['amount']:
+        # Breaks ties between similarly described lines
+        score += 0.1
+    return score
+
+def align_line_items(po_items, receipt_items):
+    """Pair PO and receipt lines, best-scoring pairs first. Extraction keeps at
+    most ten lines per document, so scoring every pair is cheap."""
+    po_lines, receipt_lines = _parse_items(po_items), _parse_items(receipt_items)
+    if not po_lines or not receipt_lines:
+        return []
+
+    pairs = sorted(
+        (
+            (-_line_score(po_line, receipt_line), i, j)
+            for i, po_line in enumerate(po_lines)
+            for j, receipt_line in enumerate(receipt_lines)
+        )
+    )
+    po_matched, receipt_matched = {}, set()
+    for negated_score, i, j in pairs:
+        score = -negated_score
+        if score < LINE_MATCH_THRESHOLD:
+            break
+        if i in po_matched or j in receipt_matched:
+            continue
+        po_matched[i] = (j, score)
+        receipt_matched.add(j)
+
+    lines = []
+    for i, po_line in enumerate(po_lines):
+        if i not in po_matched:
+            lines.append(_line_result('missing_from_receipt', po_line, None))
+            continue
+        j, score = po_matched[i]
+        receipt_line = receipt_lines[j]
+        if po_line['amount'] != receipt_line['amount']:
+            status = 'amount_mismatch'
+        elif None not in (po_line['quantity'], receipt_line['quantity']) and po_line['quantity'] != receipt_line['quantity']:
+            status = 'quantity_mismatch'
+        else:
+            status = 'matched'
+        lines.append(_line_result(status, po_line, receipt_line, score))
+    for j, receipt_line in enumerate(receipt_lines):
+        if j not in receipt_matched:
+            lines.append(_line_result('not_on_po', None, receipt_line))
+    return lines
+
+def _line_result(status, po_line, receipt_line, score=None):
+    result = {'status': status}
+    for side, line in (('po', po_line), ('receipt', receipt_line)):
+        result[f'{side}_item'] = line['text'] if line else None
+        result[f'{side}_quantity'] = line['quantity'] if line else None
+        result[f'{side}_amount'] = str(line['amount']) if line else None
+    if score is not None:
+        result['score'] = round(min(score, 1.0), 3)
+    return result
+
+def _line_discrepancy(line):
+    if line['status'] == 'missing_from_receipt':
+        return f"Missing from receipt: '{line['po_item']}'"
+    if line['status'] == 'not_on_po':
+        return f"Not on PO: '{line['receipt_item']}'"
+    if line['status'] == 'amount_mismatch':
+        return f"Line amount mismatch for '{line['po_item']}': PO=${line['po_amount']} vs Receipt=${line['receipt_amount']}"
+    if line['status'] == 'quantity_mismatch':
+        return f"Line quantity mismatch for '{line['po_item']}': PO={line['po_quantity']} vs Receipt={line['receipt_quantity']}"
+    return None
+
+def match_receipt(receipt_data, purchase_order_data, vendor_index=None):
+    """Compare extracted receipt data with a purchase order. Vendor and total
+    decide is_valid; line by line results are reported alongside, since item
+    lines parsed from PDF text are too noisy to fail a receipt on. Works on
+    stored data only, so it never opens a document."""
+    discrepancies = []
+
+    vendor = match_vendor(purchase_order_data.get('vendor', ''), receipt_data.get('vendor', ''), vendor_index)
+    if not vendor['matched']:
+        discrepancies.append(f"Vendor mismatch: PO='{purchase_order_data.get('vendor')}' vs Receipt='{receipt_data.get('vendor')}'")
+
+    po_amount = to_decimal(purchase_order_data.get('total_amount', 0)) or Decimal('0.00')
+    receipt_amount = to_decimal(receipt_data.get('amount', 0)) or Decimal('0.00')
+    if abs(po_amount - receipt_amount) > AMOUNT_TOLERANCE:
+        discrepancies.append(f"Amount mismatch: PO=${po_amount:.2f} vs Receipt=${receipt_amount:.2f}")
+
+    line_items = align_line_items(purchase_order_data.get('items'), receipt_data.get('items'))
+
+    return {
+        'is_valid': len(discrepancies) == 0,
+        'discrepancies': discrepancies,
+        'receipt_data': receipt_data,
+        'vendor': vendor,
+        'line_items': line_items,
+        'line_discrepancies': list(filter(None, map(_line_discrepancy, line_items))),
+        'matcher_version': MATCHER_VERSION,
+        'message': 'Receipt validated successfully' if len(discrepancies) == 0 else 'Discrepancies found'
+    }
+
+def stored_receipt_data(purchase_request):
+    """Receipt data kept from the last extraction, from receipt_data or, for
+    receipts validated before it was stored, from the validation result"""
+    if purchase_request.receipt_data:
+        return purchase_request.receipt_data
+    return (purchase_request.receipt_validation or {}).get('receipt_data')
+
+def revalidate_receipts(batch_size=500, force=False, dry_run=False, vendor_index=None):
+    """Re-run matching for every receipt from its stored data, in primary key
+    batches. Receipts already checked by this MATCHER_VERSION are left alone
+    unless `force` is set. Returns counts of checked, changed and skipped rows."""
+    if vendor_index is None:
+        vendor_index = build_vendor_index()
+    counts = {'checked': 0, 'changed': 0, 'skipped': 0}
+    queryset = PurchaseRequest.objects.filter(
+        purchase_order_data__isnull=False, receipt_validation__isnull=False
+    ).only('id', 'receipt_data', 'receipt_validation', 'purchase_order_data').order_by('pk')
+
+    last_pk = 0
+    while True:
+        batch = list(queryset.filter(pk__gt=last_pk)[:batch_size])
+        if not batch:
+            break
+        last_pk = batch[-1].pk
+
+        changed = []
+        for purchase_request in batch:
+            receipt_data = stored_receipt_data(purchase_request)
+            if not receipt_data:
+                # Extraction failed at upload time; only re-reading the file would help
+                counts['skipped'] += 1
+                continue
+            if not force and purchase_request.receipt_validation.get('matcher_version') == MATCHER_VERSION:
+                continue
+            counts['checked'] += 1
+            validation = match_receipt(receipt_data, purchase_request.purchase_order_data, vendor_index)
+            if validation == purchase_request.receipt_validation and purchase_request.receipt_data:
+                continue
+            purchase_request.receipt_validation = validation
+            purchase_request.receipt_data = receipt_data
+            purchase_request.updated_at = timezone.now()
+            changed.append(purchase_request)
+
+        counts['changed'] += len(changed)
+        if changed and not dry_run:
+            PurchaseRequest.objects.bulk_update(changed, ['receipt_validation', 'receipt_data', 'updated_at'])
+    return counts
@@ -0,0 +1,49 @@
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+
+from .instrumentation import end_trace, record_request, server_timing, start_trace
+
+class InstrumentationMiddleware:
+    """Time a sample of requests (INSTRUMENTATION_SAMPLE_RATE): wall time, database
+    queries and spans, kept as Prometheus metrics per view and, with
+    SERVER_TIMING_HEADER on, returned in a Server-Timing header.
+    QUERY_COUNT_HEADER times every request and adds X-Query-Count, for
+    benchmark_workflow runs."""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        trace, token = start_trace(force=settings.QUERY_COUNT_HEADER)
+        try:
+            response = self.get_response(request)
+        finally:
+            end_trace(token)
+        return self.finish(request, response, trace)
+
+    async def __acall__(self, request):
+        # The context variable set here is copied into the threads sync views
+        # and sync_to_async() calls run in, so their queries are counted too.
+        trace, token = start_trace(force=settings.QUERY_COUNT_HEADER)
+        try:
+            response = await self.get_response(request)
+        finally:
+            end_trace(token)
+        return self.finish(request, response, trace)
+
+    def finish(self, request, response, trace):
+        if trace is None:
+            return response
+        match = request.resolver_match
+        elapsed = record_request(trace, match.view_name if match else 'unmatched', request.method, response.status_code)
+        if settings.SERVER_TIMING_HEADER:
+            response['Server-Timing'] = server_timing(trace, elapsed)
+        if settings.QUERY_COUNT_HEADER:
+            response['X-Query-Count'] = trace.queries
+        return response
@@ -0,0 +1,49 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:36
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0004_role_queue_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='purchaserequest',
+            options={'ordering': ['-created_at', '-id']},
+        ),
+        migrations.RemoveIndex(
+            model_name='purchaserequest',
+            name='pr_creator_created',
+        ),
+        migrations.RemoveIndex(
+            model_name='purchaserequest',
+            name='pr_status_created',
+        ),
+        migrations.RemoveIndex(
+            model_name='purchaserequest',
+            name='pr_level_2_queue',
+        ),
+        migrations.RemoveIndex(
+            model_name='purchaserequest',
+            name='pr_created',
+        ),
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(fields=['created_by', '-created_at', '-id'], name='pr_creator_created'),
+        ),
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(fields=['status', '-created_at', '-id'], name='pr_status_created'),
+        ),
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(fields=['status', 'level_1_approved', '-created_at', '-id'], name='pr_level_2_queue'),
+        ),
+        migrations.AddIndex(
+            model_name='purchaserequest',
+            index=models.Index(fields=['-created_at', '-id'], name='pr_created'),
+        ),
+    ]
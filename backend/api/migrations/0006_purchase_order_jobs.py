@@ -0,0 +1,18 @@
+# Generated by Django 4.2.7 on 2026-10-17 07:38
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0005_keyset_ordering'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='documentjob',
+            name='kind',
+            field=models.CharField(choices=[('proforma', 'Proforma'), ('purchase_order', 'Purchase Order')], max_length=20),
+        ),
+    ]
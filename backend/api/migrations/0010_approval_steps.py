@@ -0,0 +1,141 @@
+# Generated by Django 4.2.7 on 2026-10-17 08:17
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BACKFILL_BATCH_SIZE = 2000
+
+
+def backfilled_steps(row):
+    """The two ApprovalStep rows equivalent to a request's level_1_*/level_2_* columns"""
+    steps = []
+    reached = False  # an earlier step is current or rejected the request
+    for level in (1, 2):
+        step = {'level': level, 'role': f'approver_level_{level}', 'status': 'approved',
+                'decided_by_id': None, 'decided_at': None}
+        if row[f'level_{level}_approved'] or row['status'] == 'approved':
+            step.update(decided_by_id=row[f'level_{level}_approver'], decided_at=row[f'level_{level}_approved_at'])
+        elif reached:
+            step['status'] = 'waiting' if row['status'] == 'pending' else 'cancelled'
+        elif row['status'] == 'pending':
+            step['status'] = 'pending'
+            reached = True
+        else:
+            step.update(status='rejected', decided_by_id=row['rejected_by'], decided_at=row['rejected_at'])
+            reached = True
+        steps.append(step)
+    return steps
+
+
+def backfill_steps(apps, schema_editor):
+    PurchaseRequest = apps.get_model('api', 'PurchaseRequest')
+    ApprovalStep = apps.get_model('api', 'ApprovalStep')
+    db = schema_editor.connection.alias
+    last_pk = 0
+    while True:
+        rows = list(
+            PurchaseRequest.objects.using(db).filter(pk__gt=last_pk).order_by('pk').values(
+                'pk', 'status', 'rejected_by', 'rejected_at',
+                'level_1_approved', 'level_1_approver', 'level_1_approved_at',
+                'level_2_approved', 'level_2_approver', 'level_2_approved_at',
+            )[:BACKFILL_BATCH_SIZE]
+        )
+        if not rows:
+            break
+        ApprovalStep.objects.using(db).bulk_create([
+            ApprovalStep(purchase_request_id=row['pk'], **step)
+            for row in rows for step in backfilled_steps(row)
+        ])
+        last_pk = rows[-1]['pk']
+
+
+def restore_columns(apps, schema_editor):
+    PurchaseRequest = apps.get_model('api', 'PurchaseRequest')
+    ApprovalStep = apps.get_model('api', 'ApprovalStep')
+    db = schema_editor.connection.alias
+    for level in (1, 2):
+        fields = [f'level_{level}_approved', f'level_{level}_approver', f'level_{level}_approved_at']
+        steps = ApprovalStep.objects.using(db).filter(level=level, status='approved').values_list(
+            'purchase_request_id', 'decided_by_id', 'decided_at'
+        )
+        batch = []
+        for pk, decided_by_id, decided_at in steps.iterator(chunk_size=BACKFILL_BATCH_SIZE):
+            batch.append(PurchaseRequest(pk=pk, **{
+                fields[0]: True, f'{fields[1]}_id': decided_by_id, fields[2]: decided_at
+            }))
+            if len(batch) == BACKFILL_BATCH_SIZE:
+                PurchaseRequest.objects.using(db).bulk_update(batch, fields)
+                batch = []
+        PurchaseRequest.objects.using(db).bulk_update(batch, fields)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('api', '0009_request_version'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ApprovalStep',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('level', models.PositiveSmallIntegerField()),
+                ('role', models.CharField(choices=[('staff', 'Staff'), ('approver_level_1', 'Approver Level 1'), ('approver_level_2', 'Approver Level 2'), ('finance', 'Finance')], max_length=20)),
+                ('status', models.CharField(choices=[('waiting', 'Waiting'), ('pending', 'Pending'), ('approved', 'Approved'), ('rejected', 'Rejected'), ('cancelled', 'Cancelled')], default='waiting', max_length=20)),
+                ('decided_at', models.DateTimeField(blank=True, null=True)),
+            ],
+            options={
+                'ordering': ['level'],
+            },
+        ),
+        migrations.AddField(
+            model_name='approvalstep',
+            name='decided_by',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='approval_decisions', to=settings.AUTH_USER_MODEL),
+        ),
+        migrations.AddField(
+            model_name='approvalstep',
+            name='purchase_request',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='approval_steps', to='api.purchaserequest'),
+        ),
+        migrations.AddIndex(
+            model_name='approvalstep',
+            index=models.Index(condition=models.Q(('status', 'pending')), fields=['role', 'purchase_request'], name='step_queue'),
+        ),
+        migrations.AddConstraint(
+            model_name='approvalstep',
+            constraint=models.UniqueConstraint(fields=('purchase_request', 'level'), name='unique_request_level'),
+        ),
+        migrations.RunPython(backfill_steps, restore_columns),
+        migrations.RemoveIndex(
+            model_name='purchaserequest',
+            name='pr_level_2_queue',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_1_approved',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_1_approved_at',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_1_approver',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_2_approved',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_2_approved_at',
+        ),
+        migrations.RemoveField(
+            model_name='purchaserequest',
+            name='level_2_approver',
+        ),
+    ]
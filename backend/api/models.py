@@ -1,6 +1,14 @@
+import os
+import uuid
+from collections import defaultdict
+
+from django.conf import settings
 from django.contrib.auth.models import AbstractUser
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
+from django.utils import timezone
+
+from .workflow import DECIDED_STATUSES, activate, approver_roles, current_step, levels_for
 
 class User(AbstractUser):
     ROLE_CHOICES = [
@@ -14,6 +22,43 @@ class User(AbstractUser):
     def __str__(self):
         return f"{self.username} ({self.get_role_display()})"
 
+class PurchaseRequestQuerySet(models.QuerySet):
+    def visible_to(self, user):
+        """Requests in the user's role-based queue"""
+        if user.role == 'staff':
+            return self.filter(created_by=user)
+        elif user.role in approver_roles():
+            # Requests whose current step is the user's, read off the step_queue index
+            return self.filter(approval_steps__role=user.role, approval_steps__status='pending')
+        
+        return self
+    
+    def transition(self, version, changes):
+        """UPDATE only the `changes` columns of the rows still at `version`,
+        bumping it. Returns the number of rows written; fewer than expected
+        means someone else changed a row first."""
+        return self.filter(version=version).update(version=F('version') + 1, **changes)
+
+def queue_contains(user, created_by_id, current_role):
+    """Whether a request created by `created_by_id`, awaiting `current_role` (None
+    once decided), is in the user's queue; keep in step with PurchaseRequestQuerySet.visible_to"""
+    if user.role == 'staff':
+        return created_by_id == user.pk
+    elif user.role in approver_roles():
+        return current_role == user.role
+    
+    return True
+
+def _level_property(level, attribute):
+    """Read-only stand-in for the level_N_* columns the approval steps replaced"""
+    def get(purchase_request):
+        step = purchase_request.approval_step(level)
+        approved = step is not None and step.status == 'approved'
+        if attribute == 'approved':
+            return approved
+        return getattr(step, attribute) if approved else None
+    return property(get)
+
 class PurchaseRequest(models.Model):
     STATUS_CHOICES = [
         ('pending', 'Pending'),
@@ -21,6 +66,13 @@ class PurchaseRequest(models.Model):
         ('rejected', 'Rejected'),
     ]
     
+    EXTRACTION_STATUS_CHOICES = [
+        ('queued', 'Queued'),
+        ('running', 'Running'),
+        ('done', 'Done'),
+        ('failed', 'Failed'),
+    ]
+    
     title = models.CharField(max_length=255)
     description = models.TextField()
     amount = models.DecimalField(max_digits=10, decimal_places=2)
@@ -40,20 +92,38 @@ class PurchaseRequest(models.Model):
     receipt_data = models.JSONField(null=True, blank=True)
     receipt_validation = models.JSONField(null=True, blank=True)
     
-    level_1_approved = models.BooleanField(default=False)
-    level_1_approver = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='level_1_approvals')
-    level_1_approved_at = models.DateTimeField(null=True, blank=True)
-    
-    level_2_approved = models.BooleanField(default=False)
-    level_2_approver = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='level_2_approvals')
-    level_2_approved_at = models.DateTimeField(null=True, blank=True)
+    extraction_status = models.CharField(max_length=20, choices=EXTRACTION_STATUS_CHOICES, null=True, blank=True)
     
     rejected_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='rejections')
     rejected_at = models.DateTimeField(null=True, blank=True)
     rejection_reason = models.TextField(null=True, blank=True)
     
+    # Bumped by every approval, rejection and edit, so a change is only
+    # written if nobody else changed the request since it was read
+    version = models.PositiveIntegerField(default=0)
+    
+    objects = PurchaseRequestQuerySet.as_manager()
+    
+    # Approval progress lives in ApprovalStep rows; the API still reports the
+    # first two levels in the fields they used to be stored in.
+    level_1_approved = _level_property(1, 'approved')
+    level_1_approver = _level_property(1, 'decided_by')
+    level_1_approved_at = _level_property(1, 'decided_at')
+    level_2_approved = _level_property(2, 'approved')
+    level_2_approver = _level_property(2, 'decided_by')
+    level_2_approved_at = _level_property(2, 'decided_at')
+    
     class Meta:
-        ordering = ['-created_at']
+        ordering = ['-created_at', '-id']
+        # Indexes for the staff and finance queues in
+        # PurchaseRequestQuerySet.visible_to, each ending in (created_at, id)
+        # so the default ordering and keyset pagination are read off the index.
+        # Approver queues go through ApprovalStep's step_queue index.
+        indexes = [
+            models.Index(fields=['created_by', '-created_at', '-id'], name='pr_creator_created'),
+            models.Index(fields=['status', '-created_at', '-id'], name='pr_status_created'),
+            models.Index(fields=['-created_at', '-id'], name='pr_created'),
+        ]
         constraints = [
             models.CheckConstraint(
                 check=Q(status='pending') | Q(status='approved') | Q(status='rejected'),
@@ -64,23 +134,200 @@ class PurchaseRequest(models.Model):
     def __str__(self):
         return f"{self.title} - {self.status}"
     
-    def can_approve_level_1(self, user):
-        return (
-            self.status == 'pending' and
-            not self.level_1_approved and
-            user.role == 'approver_level_1'
-        )
-    
-    def can_approve_level_2(self, user):
-        return (
-            self.status == 'pending' and
-            self.level_1_approved and
-            not self.level_2_approved and
-            user.role == 'approver_level_2'
-        )
-    
-    def can_reject(self, user):
-        return (
-            self.status == 'pending' and
-            user.role in ['approver_level_1', 'approver_level_2']
-        )
\ No newline at end of file
+    def apply_transition(self, changes):
+        """Write `changes` (field name to value) if the request is still at this
+        instance's version, and update the instance to match. Returns False
+        without writing anything when another writer got there first."""
+        changes = dict(changes, updated_at=timezone.now())
+        if not PurchaseRequest.objects.filter(pk=self.pk).transition(self.version, changes):
+            return False
+        for field, value in changes.items():
+            setattr(self, field, value)
+        self.version += 1
+        return True
+    
+    def approval_step(self, level):
+        # Goes through all() so prefetched steps are used
+        return next((step for step in self.approval_steps.all() if step.level == level), None)
+    
+    def current_role(self):
+        """Role whose decision the request is waiting for, None once it is decided"""
+        step = current_step(self.approval_steps.all())
+        return step.role if step else None
+    
+    def can_decide(self, user):
+        """Whether it is the user's turn to approve or reject the request"""
+        return self.status == 'pending' and self.current_role() == user.role
+    
+    def is_visible_to(self, user):
+        """Whether the request is in the user's queue"""
+        return queue_contains(user, self.created_by_id, self.current_role())
+    
+    def plan_approval(self):
+        """Create the approval steps of a new request, the lowest level current"""
+        steps = [
+            ApprovalStep(purchase_request=self, level=level, role=role)
+            for level, role in levels_for(self.amount)
+        ]
+        for step, status in activate(steps):
+            step.status = status
+        ApprovalStep.objects.bulk_create(steps)
+    
+    def replan_approval(self):
+        """Re-route a pending request after its amount changed: add the levels it
+        now needs, drop undecided ones it no longer does and make the lowest
+        undecided level current. Approvals already given stand."""
+        steps = list(self.approval_steps.all())
+        needed = dict(levels_for(self.amount))
+        dropped = [step.pk for step in steps if step.status not in DECIDED_STATUSES and step.level not in needed]
+        steps = [step for step in steps if step.pk not in dropped]
+        added = [
+            ApprovalStep(purchase_request=self, level=level, role=role)
+            for level, role in needed.items() if level not in {step.level for step in steps}
+        ]
+        moved = []
+        for step, status in activate(steps + added):
+            if step.pk is None:
+                step.status = status
+            else:
+                moved.append((step, status))
+        
+        ApprovalStep.objects.filter(pk__in=dropped).delete()
+        ApprovalStep.objects.bulk_create(added)
+        ApprovalStep.objects.move(moved)
+        # Steps prefetched with the request no longer match the table
+        getattr(self, '_prefetched_objects_cache', {}).pop('approval_steps', None)
+
+class ApprovalStepQuerySet(models.QuerySet):
+    def move(self, changes, user=None, now=None):
+        """Write [(step, new status)] pairs from api.workflow with one UPDATE per
+        status, recording `user` and `now` on approvals and rejections, and
+        update the step objects to match"""
+        by_status = defaultdict(list)
+        for step, status in changes:
+            by_status[status].append(step)
+        
+        for status, steps in by_status.items():
+            fields = {'status': status}
+            if status in ('approved', 'rejected'):
+                fields.update(decided_by=user, decided_at=now)
+            self.filter(pk__in=[step.pk for step in steps]).update(**fields)
+            for step in steps:
+                for field, value in fields.items():
+                    setattr(step, field, value)
+
+class ApprovalStep(models.Model):
+    """One level of a request's approval workflow, in api.workflow's states"""
+    STATUS_CHOICES = [
+        ('waiting', 'Waiting'),
+        ('pending', 'Pending'),
+        ('approved', 'Approved'),
+        ('rejected', 'Rejected'),
+        ('cancelled', 'Cancelled'),
+    ]
+    
+    # Indexed by the unique (purchase_request, level) constraint
+    purchase_request = models.ForeignKey(
+        PurchaseRequest, on_delete=models.CASCADE, related_name='approval_steps', db_index=False
+    )
+    level = models.PositiveSmallIntegerField()
+    role = models.CharField(max_length=20, choices=User.ROLE_CHOICES)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='waiting')
+    decided_by = models.ForeignKey(User, on_delete=models.SET_NULL, null=True, blank=True, related_name='approval_decisions')
+    decided_at = models.DateTimeField(null=True, blank=True)
+    
+    objects = ApprovalStepQuerySet.as_manager()
+    
+    class Meta:
+        ordering = ['level']
+        indexes = [
+            # Approver queues. Only current steps are indexed, so it stays small
+            # however many levels, approvers and finished requests there are.
+            models.Index(fields=['role', 'purchase_request'], name='step_queue', condition=Q(status='pending')),
+        ]
+        constraints = [
+            models.UniqueConstraint(fields=['purchase_request', 'level'], name='unique_request_level'),
+        ]
+    
+    def __str__(self):
+        return f"{self.purchase_request_id} level {self.level} ({self.role}) - {self.status}"
+
+class DocumentJob(models.Model):
+    KIND_CHOICES = [
+        ('proforma', 'Proforma'),
+        ('purchase_order', 'Purchase Order'),
+    ]
+    STATUS_CHOICES = PurchaseRequest.EXTRACTION_STATUS_CHOICES
+    
+    purchase_request = models.ForeignKey(PurchaseRequest, on_delete=models.CASCADE, related_name='document_jobs')
+    kind = models.CharField(max_length=20, choices=KIND_CHOICES)
+    file_name = models.CharField(max_length=255)
+    status = models.CharField(max_length=20, choices=STATUS_CHOICES, default='queued')
+    attempts = models.PositiveIntegerField(default=0)
+    error = models.TextField(null=True, blank=True)
+    
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    
+    class Meta:
+        ordering = ['created_at']
+        indexes = [
+            models.Index(fields=['status', 'created_at'], name='documentjob_status_created'),
+        ]
+    
+    def __str__(self):
+        return f"{self.kind} job for request {self.purchase_request_id} - {self.status}"
+
+class ExtractionCacheEntry(models.Model):
+    key = models.CharField(max_length=100, primary_key=True)
+    payload = models.TextField()
+    size = models.PositiveIntegerField()
+    created_at = models.DateTimeField(auto_now_add=True)
+    last_used_at = models.DateTimeField(auto_now_add=True, db_index=True)
+    
+    def __str__(self):
+        return self.key
+
+class SpendRollup(models.Model):
+    """Request count and total amount per (month, status, creator, vendor) bucket,
+    kept up to date by api.analytics.record_spend_changes"""
+    month = models.DateField()
+    status = models.CharField(max_length=20, choices=PurchaseRequest.STATUS_CHOICES)
+    created_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name='spend_rollups')
+    vendor = models.CharField(max_length=255, blank=True, default='')
+    request_count = models.IntegerField(default=0)
+    total_amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    
+    class Meta:
+        ordering = ['month', 'status']
+        constraints = [
+            models.UniqueConstraint(
+                fields=['month', 'status', 'created_by', 'vendor'],
+                name='spend_rollup_bucket'
+            )
+        ]
+    
+    def __str__(self):
+        return f"{self.month:%Y-%m} {self.status} {self.vendor or '-'}: {self.total_amount}"
+
+class ChunkedUpload(models.Model):
+    """A file sent in chunks into UPLOAD_STAGING_DIR, attached to a request once complete"""
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    user = models.ForeignKey(User, on_delete=models.CASCADE, related_name='uploads')
+    file_name = models.CharField(max_length=255)
+    size = models.PositiveBigIntegerField()
+    offset = models.PositiveBigIntegerField(default=0)
+    created_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
+    
+    @property
+    def staging_path(self):
+        return os.path.join(settings.UPLOAD_STAGING_DIR, f"{self.pk}.part")
+    
+    @property
+    def is_complete(self):
+        return self.offset == self.size
+    
+    def __str__(self):
+        return f"{self.file_name} ({self.offset}/{self.size})"
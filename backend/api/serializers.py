@@ -1,5 +1,8 @@
+from django.conf import settings
 from rest_framework import serializers
-from .models import User, PurchaseRequest
+from .instrumentation import span
+from .models import User, PurchaseRequest, ApprovalStep, ChunkedUpload
+from .uploads import release_staged, staged_file
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -25,8 +28,33 @@ class RegisterSerializer(serializers.ModelSerializer):
         )
         return user
 
+class TimedListSerializer(serializers.ListSerializer):
+    @property
+    def data(self):
+        with span('serialize'):
+            return super().data
+
+class ApprovalStepSerializer(serializers.ModelSerializer):
+    decided_by_name = serializers.CharField(source='decided_by.get_full_name', read_only=True)
+    
+    class Meta:
+        model = ApprovalStep
+        fields = ['level', 'role', 'status', 'decided_by', 'decided_by_name', 'decided_at']
+        read_only_fields = fields
+
 class PurchaseRequestSerializer(serializers.ModelSerializer):
+    # Large JSON columns left out of compact list responses
+    DOCUMENT_DATA_FIELDS = ['proforma_data', 'purchase_order_data', 'receipt_data', 'receipt_validation']
+    
     created_by_name = serializers.CharField(source='created_by.get_full_name', read_only=True)
+    approval_steps = ApprovalStepSerializer(many=True, read_only=True)
+    # The first two levels in the fields clients read before approval steps
+    level_1_approved = serializers.BooleanField(read_only=True)
+    level_1_approver = serializers.PrimaryKeyRelatedField(read_only=True)
+    level_1_approved_at = serializers.DateTimeField(read_only=True)
+    level_2_approved = serializers.BooleanField(read_only=True)
+    level_2_approver = serializers.PrimaryKeyRelatedField(read_only=True)
+    level_2_approved_at = serializers.DateTimeField(read_only=True)
     level_1_approver_name = serializers.CharField(source='level_1_approver.get_full_name', read_only=True)
     level_2_approver_name = serializers.CharField(source='level_2_approver.get_full_name', read_only=True)
     rejected_by_name = serializers.CharField(source='rejected_by.get_full_name', read_only=True)
@@ -36,26 +64,114 @@ class PurchaseRequestSerializer(serializers.ModelSerializer):
         fields = '__all__'
         read_only_fields = [
             'created_by', 'created_at', 'updated_at', 'status',
-            'level_1_approved', 'level_1_approver', 'level_1_approved_at',
-            'level_2_approved', 'level_2_approver', 'level_2_approved_at',
             'rejected_by', 'rejected_at', 'purchase_order', 'purchase_order_data',
-            'proforma_data', 'receipt_data', 'receipt_validation'
+            'proforma_data', 'receipt_data', 'receipt_validation',
+            'extraction_status', 'version'
         ]
+        list_serializer_class = TimedListSerializer
+    
+    def __init__(self, *args, **kwargs):
+        fields = kwargs.pop('fields', None)
+        super().__init__(*args, **kwargs)
+        
+        if fields is not None:
+            for name in set(self.fields) - set(fields):
+                self.fields.pop(name)
+    
+    @property
+    def data(self):
+        with span('serialize'):
+            return super().data
+
+class StagedUploadField(serializers.UUIDField):
+    """Id of a completed chunked upload by the requesting user; validates to a StagedFile"""
+    
+    def to_internal_value(self, data):
+        pk = super().to_internal_value(data)
+        upload = ChunkedUpload.objects.filter(pk=pk, user=self.context['request'].user).first()
+        if upload is None:
+            raise serializers.ValidationError('Upload not found')
+        if not upload.is_complete:
+            raise serializers.ValidationError(
+                f'Upload is incomplete ({upload.offset} of {upload.size} bytes)'
+            )
+        return staged_file(upload)
+
+def use_staged_upload(attrs, field_name):
+    """Accept a file either directly or as `<field>_upload`, but not both"""
+    upload_field = f'{field_name}_upload'
+    if upload_field in attrs:
+        if attrs.get(field_name):
+            raise serializers.ValidationError(f'Send either {field_name} or {upload_field}, not both')
+        attrs[field_name] = attrs.pop(upload_field)
+    return attrs
+
+class ChunkedUploadSerializer(serializers.ModelSerializer):
+    complete = serializers.BooleanField(source='is_complete', read_only=True)
+    
+    class Meta:
+        model = ChunkedUpload
+        fields = ['id', 'file_name', 'size', 'offset', 'complete', 'created_at']
+        read_only_fields = ['id', 'offset', 'created_at']
+    
+    def validate_size(self, value):
+        if value <= 0 or value > settings.UPLOAD_MAX_FILE_BYTES:
+            raise serializers.ValidationError(
+                f'Size must be between 1 and {settings.UPLOAD_MAX_FILE_BYTES} bytes'
+            )
+        return value
 
 class PurchaseRequestCreateSerializer(serializers.ModelSerializer):
+    proforma_upload = StagedUploadField(write_only=True, required=False)
+    
     class Meta:
         model = PurchaseRequest
-        fields = ['title', 'description', 'amount', 'proforma']
+        fields = ['title', 'description', 'amount', 'proforma', 'proforma_upload']
+    
+    def validate(self, attrs):
+        return use_staged_upload(attrs, 'proforma')
     
     def create(self, validated_data):
         validated_data['created_by'] = self.context['request'].user
         return super().create(validated_data)
+    
+    def update(self, instance, validated_data):
+        # Only the edited columns, so extraction results written meanwhile survive
+        for field, value in validated_data.items():
+            setattr(instance, field, value)
+        instance.save(update_fields=[*validated_data, 'updated_at'])
+        return instance
+    
+    def save(self, **kwargs):
+        instance = super().save(**kwargs)
+        release_staged(self.validated_data.get('proforma'))
+        return instance
 
-class ApprovalSerializer(serializers.Serializer):
+class TransitionSerializer(serializers.Serializer):
+    """`version` is the request version the client last saw; when given, the
+    change is refused with 409 if the request has changed since"""
+    version = serializers.IntegerField(required=False, min_value=0)
+
+class ApprovalSerializer(TransitionSerializer):
     pass
 
-class RejectionSerializer(serializers.Serializer):
+class RejectionSerializer(TransitionSerializer):
+    reason = serializers.CharField(required=True)
+
+class BulkApprovalSerializer(serializers.Serializer):
+    ids = serializers.ListField(
+        child=serializers.IntegerField(), allow_empty=False, max_length=500
+    )
+
+class BulkRejectionSerializer(BulkApprovalSerializer):
     reason = serializers.CharField(required=True)
 
 class ReceiptUploadSerializer(serializers.Serializer):
-    receipt = serializers.FileField(required=True)
\ No newline at end of file
+    receipt = serializers.FileField(required=False)
+    receipt_upload = StagedUploadField(required=False)
+    
+    def validate(self, attrs):
+        attrs = use_staged_upload(attrs, 'receipt')
+        if not attrs.get('receipt'):
+            raise serializers.ValidationError({'receipt': 'Send receipt or receipt_upload'})
+        return attrs
\ No newline at end of file
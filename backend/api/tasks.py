@@ -0,0 +1,307 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import timedelta
+from io import BytesIO
+
+import django
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import close_old_connections, connection, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from .models import PurchaseRequest, DocumentJob
+from .analytics import bucket_for, record_spend_changes, spend_bucket
+from .document_processor import (
+    extract_proforma_data, generate_purchase_order, render_purchase_order, validate_receipt
+)
+
+# In-process stand-in for the worker command, used when
+# DOCUMENT_QUEUE_BACKEND is 'in_process' (local runs without a worker).
+_in_process_executor = None
+
+def _get_in_process_executor():
+    global _in_process_executor
+    if _in_process_executor is None:
+        _in_process_executor = ThreadPoolExecutor(
+            max_workers=settings.DOCUMENT_QUEUE_IN_PROCESS_WORKERS,
+            thread_name_prefix='document-jobs'
+        )
+    return _in_process_executor
+
+# Process pool for extraction awaited by async views, so PDF parsing in the
+# web process does not hold the GIL the event loop runs under.
+_extraction_process_pool = None
+
+def get_extraction_process_pool():
+    global _extraction_process_pool
+    if _extraction_process_pool is None:
+        _extraction_process_pool = ProcessPoolExecutor(
+            max_workers=settings.ASYNC_EXTRACTION_PROCESSES,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=django.setup,
+        )
+    return _extraction_process_pool
+
+def validate_receipt_source(source, purchase_order_data):
+    """Runs in a pool process: validate a receipt given as a local path or raw bytes"""
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    return validate_receipt(source, purchase_order_data)
+
+def reextract_source(kind, source, purchase_order_data=None):
+    """Runs in a pool process: read a stored proforma or receipt again under the current rules"""
+    if isinstance(source, bytes):
+        source = BytesIO(source)
+    if kind == 'proforma':
+        return extract_proforma_data(source)
+    return validate_receipt(source, purchase_order_data)
+
+def store_reextracted(results):
+    """Write (pk, kind, file_name, data) results back with one bulk_update,
+    skipping documents that were replaced while they were being read"""
+    documents = {}
+    for pk, kind, file_name, data in results:
+        documents.setdefault(pk, {})[kind] = (file_name, data)
+    
+    with transaction.atomic():
+        requests = PurchaseRequest.objects.select_for_update().only(
+            'id', 'created_at', 'status', 'created_by_id', 'amount', 'proforma', 'receipt',
+            'proforma_data', 'extraction_status', 'receipt_data', 'receipt_validation',
+        ).in_bulk(list(documents))
+        
+        changed = []
+        spend_changes = []
+        now = timezone.now()
+        for pk, by_kind in documents.items():
+            purchase_request = requests.get(pk)
+            if purchase_request is None:
+                continue
+            touched = False
+            file_name, data = by_kind.get('proforma', (None, None))
+            if file_name and purchase_request.proforma.name == file_name:
+                before = (bucket_for(purchase_request), purchase_request.amount)
+                purchase_request.proforma_data = data
+                purchase_request.extraction_status = 'done'
+                spend_changes.append((before, (bucket_for(purchase_request), purchase_request.amount)))
+                touched = True
+            file_name, data = by_kind.get('receipt', (None, None))
+            if file_name and purchase_request.receipt.name == file_name:
+                purchase_request.receipt_validation = data
+                purchase_request.receipt_data = data['receipt_data']
+                touched = True
+            if touched:
+                purchase_request.updated_at = now
+                # As in complete_job: decisions based on the old data are stale
+                purchase_request.version = F('version') + 1
+                changed.append(purchase_request)
+        
+        PurchaseRequest.objects.bulk_update(changed, [
+            'proforma_data', 'extraction_status', 'receipt_data', 'receipt_validation', 'updated_at', 'version'
+        ])
+        # A proforma read differently may name a different vendor
+        record_spend_changes(spend_changes)
+    return len(changed)
+
+def enqueue_proforma_extraction(purchase_request):
+    """Queue extraction of the request's proforma and mark it as queued"""
+    job = DocumentJob.objects.create(
+        purchase_request=purchase_request,
+        kind='proforma',
+        file_name=purchase_request.proforma.name,
+    )
+    purchase_request.extraction_status = 'queued'
+    PurchaseRequest.objects.filter(pk=purchase_request.pk).update(extraction_status='queued', updated_at=timezone.now())
+
+    if settings.DOCUMENT_QUEUE_BACKEND == 'in_process':
+        transaction.on_commit(
+            lambda: _get_in_process_executor().submit(_run_in_process, job.pk)
+        )
+
+    return job
+
+def _run_in_process(job_id):
+    try:
+        job = claim_job(job_id)
+        if job is None:
+            return
+        try:
+            data = extract_proforma_data(open_job_source(job))
+        except Exception as e:
+            fail_job(job, e)
+        else:
+            complete_job(job, data)
+    finally:
+        close_old_connections()
+
+def enqueue_purchase_orders(purchase_requests):
+    """Queue PO generation for requests that have just been fully approved"""
+    jobs = DocumentJob.objects.bulk_create([
+        DocumentJob(purchase_request=purchase_request, kind='purchase_order', file_name='')
+        for purchase_request in purchase_requests
+    ])
+
+    if settings.DOCUMENT_QUEUE_BACKEND == 'in_process':
+        transaction.on_commit(
+            lambda: _get_in_process_executor().submit(_run_purchase_orders_in_process)
+        )
+
+    return jobs
+
+def _run_purchase_orders_in_process():
+    try:
+        jobs = claim_jobs(settings.PURCHASE_ORDER_BATCH_SIZE, kind='purchase_order')
+        if jobs:
+            generate_purchase_orders(jobs)
+    finally:
+        close_old_connections()
+
+def generate_purchase_orders(jobs):
+    """Render and store POs for a batch of claimed jobs, loading approvers in one query per table"""
+    requests = PurchaseRequest.objects.prefetch_related(
+        'approval_steps__decided_by'
+    ).in_bulk([job.purchase_request_id for job in jobs])
+
+    generated = []
+    done_jobs = []
+    for job in jobs:
+        purchase_request = requests.get(job.purchase_request_id)
+        if purchase_request is None or purchase_request.status != 'approved':
+            fail_job(job, 'Request is no longer approved')
+            continue
+        try:
+            po_data = generate_purchase_order(purchase_request)
+            purchase_request.purchase_order.save(
+                f"{po_data['po_number']}.html",
+                ContentFile(render_purchase_order(purchase_request, po_data).encode()),
+                save=False
+            )
+        except Exception as e:
+            fail_job(job, e)
+            continue
+        purchase_request.purchase_order_data = po_data
+        purchase_request.updated_at = timezone.now()
+        generated.append(purchase_request)
+        done_jobs.append(job.pk)
+
+    with transaction.atomic():
+        PurchaseRequest.objects.bulk_update(generated, ['purchase_order', 'purchase_order_data', 'updated_at'])
+        DocumentJob.objects.filter(pk__in=done_jobs).update(
+            status='done', error=None, finished_at=timezone.now(), attempts=F('attempts') + 1
+        )
+    return generated
+
+def claim_job(job_id):
+    """Move a single queued job to running, or return None if already taken"""
+    claimed = DocumentJob.objects.filter(pk=job_id, status='queued').update(
+        status='running', started_at=timezone.now()
+    )
+    if not claimed:
+        return None
+    job = DocumentJob.objects.get(pk=job_id)
+    _mark_running(job)
+    return job
+
+def claim_jobs(limit, kind='proforma'):
+    """Claim up to `limit` queued jobs of one kind, oldest first"""
+    with transaction.atomic():
+        jobs = list(
+            DocumentJob.objects.select_for_update(skip_locked=True)
+            .filter(status='queued', kind=kind)
+            .order_by('created_at')[:limit]
+        )
+        if not jobs:
+            return []
+
+        now = timezone.now()
+        queued = DocumentJob.objects.filter(status='queued')
+        if connection.features.has_select_for_update_skip_locked:
+            # The rows are locked, so nobody else can have claimed them
+            queued.filter(pk__in=[job.pk for job in jobs]).update(status='running', started_at=now)
+        else:
+            # Without row locks (SQLite) another worker may have read the same
+            # jobs, so keep only those this worker's update moved out of queued
+            jobs = [
+                job for job in jobs
+                if queued.filter(pk=job.pk).update(status='running', started_at=now)
+            ]
+        for job in jobs:
+            job.status = 'running'
+            job.started_at = now
+            _mark_running(job)
+    return jobs
+
+def requeue_stale_jobs(max_age):
+    """Requeue jobs left running by a worker that died mid-extraction"""
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    return DocumentJob.objects.filter(status='running', started_at__lt=cutoff).update(
+        status='queued', started_at=None
+    )
+
+def file_source(field_name, file_name):
+    """Return something another process can open: a local path, or the raw bytes"""
+    storage = PurchaseRequest._meta.get_field(field_name).storage
+    try:
+        return storage.path(file_name)
+    except NotImplementedError:
+        with storage.open(file_name, 'rb') as f:
+            return f.read()
+
+def job_source(job):
+    return file_source(job.kind, job.file_name)
+
+def open_job_source(job):
+    source = job_source(job)
+    if isinstance(source, bytes):
+        return BytesIO(source)
+    return source
+
+def complete_job(job, data):
+    """Store extracted data, unless the file has been replaced since the job was queued"""
+    with transaction.atomic():
+        _finish_job(job, 'done')
+        current = PurchaseRequest.objects.select_for_update().filter(
+            pk=job.purchase_request_id, **{job.kind: job.file_name}
+        )
+        row = current.values_list(
+            'created_at', 'status', 'created_by_id', 'amount', 'proforma_data__vendor'
+        ).first()
+        if row is None:
+            return
+        # A new version, so an approval or rejection that read the request
+        # before this moved it to another spend bucket is refused as stale.
+        current.update(**{
+            f'{job.kind}_data': data, 'extraction_status': 'done',
+            'updated_at': timezone.now(), 'version': F('version') + 1,
+        })
+        
+        # The vendor is only known once the proforma is read, so the request
+        # moves to its vendor's spend bucket here.
+        created_at, status, created_by_id, amount, vendor = row
+        record_spend_changes([(
+            (spend_bucket(created_at, status, created_by_id, vendor), amount),
+            (spend_bucket(created_at, status, created_by_id, data.get('vendor')), amount),
+        )])
+
+def fail_job(job, error):
+    with transaction.atomic():
+        _finish_job(job, 'failed', error=str(error))
+        if job.kind != 'proforma':
+            return
+        PurchaseRequest.objects.filter(
+            pk=job.purchase_request_id, **{job.kind: job.file_name}
+        ).update(extraction_status='failed', updated_at=timezone.now())
+
+def _finish_job(job, status, error=None):
+    job.status = status
+    job.error = error
+    job.finished_at = timezone.now()
+    job.attempts += 1
+    job.save(update_fields=['status', 'error', 'finished_at', 'attempts'])
+
+def _mark_running(job):
+    if job.kind != 'proforma':
+        return
+    PurchaseRequest.objects.filter(
+        pk=job.purchase_request_id, **{job.kind: job.file_name}
+    ).update(extraction_status='running', updated_at=timezone.now())
@@ -0,0 +1,459 @@
+import hashlib
+import io
+import os
+import tempfile
+from contextlib import contextmanager
+from pathlib import Path
+from unittest import mock
+
+from django.db import OperationalError, connections
+from django.test import TestCase, override_settings
+from rest_framework.test import APIClient, APITestCase
+
+from .analytics import rebuild_spend_rollups
+from .matching import VendorIndex, match_receipt
+from .document_processor import extract_proforma_data
+from .extraction_cache import DatabaseStore
+from .models import (
+    ApprovalStep, ChunkedUpload, DocumentJob, ExtractionCacheEntry, PurchaseRequest, SpendRollup, User
+)
+from .tasks import complete_job, store_reextracted
+from .uploads import ChunkError, append_chunk
+from .views import on_request_created
+
+TEST_DOCUMENTS = Path(__file__).resolve().parent / 'test_documents'
+
+def spend_rollups():
+    """Non-empty rollup buckets; incremental updates can leave zeroed rows behind"""
+    return set(
+        SpendRollup.objects.exclude(request_count=0, total_amount=0)
+        .values_list('month', 'status', 'created_by_id', 'vendor', 'request_count', 'total_amount')
+    )
+
+def rebuilt_spend_rollups():
+    rebuild_spend_rollups()
+    return spend_rollups()
+
+class QueryCountTests(TestCase):
+    """The request list and detail cost a fixed number of queries, however many
+    rows and approval steps they serialize"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', password='x', role='staff')
+        cls.approver = User.objects.create_user('approver', password='x', role='approver_level_1')
+        cls.finance = User.objects.create_user('finance', password='x', role='finance')
+    
+    def client_for(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+    
+    def create_requests(self, count):
+        approver = self.client_for(self.approver)
+        for i in range(count):
+            purchase_request = PurchaseRequest.objects.create(
+                title=f'Request {i}', description='Office supplies', amount=100, created_by=self.staff
+            )
+            on_request_created(purchase_request)
+            # A decided step, so the approver names are prefetched too
+            approver.patch(f'/api/requests/{purchase_request.pk}/approve/')
+    
+    def assertListQueries(self, rows):
+        client = self.client_for(self.finance)
+        # Validators, page, approval steps, deciding users
+        with self.assertNumQueries(4):
+            response = client.get('/api/requests/', {'page_size': 100})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), rows)
+    
+    def test_list_queries_do_not_grow_with_page_size(self):
+        self.create_requests(5)
+        self.assertListQueries(5)
+        self.create_requests(55)
+        self.assertListQueries(60)
+    
+    def test_detail_queries(self):
+        self.create_requests(1)
+        purchase_request = PurchaseRequest.objects.get()
+        client = self.client_for(self.finance)
+        with self.assertNumQueries(4):
+            response = client.get(f'/api/requests/{purchase_request.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['approval_steps'][0]['status'], 'approved')
+
+class ConditionalRequestTests(TestCase):
+    
+    def test_list_revalidates_on_etag_only(self):
+        staff = User.objects.create_user('staff', password='x', role='staff')
+        approver = User.objects.create_user('approver', password='x', role='approver_level_1')
+        for title in ('First', 'Second'):
+            on_request_created(PurchaseRequest.objects.create(
+                title=title, description='Office supplies', amount=100, created_by=staff
+            ))
+        client = APIClient()
+        client.force_authenticate(approver)
+        
+        response = client.get('/api/requests/')
+        self.assertNotIn('Last-Modified', response)
+        etag = response['ETag']
+        self.assertEqual(client.get('/api/requests/', HTTP_IF_NONE_MATCH=etag).status_code, 304)
+        
+        # Approving the most recently updated request drops the newest
+        # updated_at from this approver's queue; the list must still change.
+        newest = PurchaseRequest.objects.latest('updated_at')
+        client.patch(f'/api/requests/{newest.pk}/approve/')
+        response = client.get(
+            '/api/requests/', HTTP_IF_NONE_MATCH=etag, HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT'
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()['results']), 1)
+    
+    def test_detail_sends_last_modified(self):
+        staff = User.objects.create_user('staff', password='x', role='staff')
+        purchase_request = PurchaseRequest.objects.create(
+            title='First', description='Office supplies', amount=100, created_by=staff
+        )
+        client = APIClient()
+        client.force_authenticate(staff)
+        self.assertIn('Last-Modified', client.get(f'/api/requests/{purchase_request.pk}/'))
+
+class OptimisticConcurrencyTests(APITestCase):
+    """A change made on an outdated read of a request is refused with 409 and the
+    request as it is now, and writes nothing"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', password='x', role='staff')
+        cls.approver = User.objects.create_user('approver', password='x', role='approver_level_1')
+        cls.other_approver = User.objects.create_user('other', password='x', role='approver_level_1')
+    
+    def setUp(self):
+        self.purchase_request = self.create_request()
+        self.client.force_authenticate(self.approver)
+    
+    def create_request(self, title='Chairs'):
+        purchase_request = PurchaseRequest.objects.create(
+            title=title, description='Office supplies', amount=100, created_by=self.staff
+        )
+        on_request_created(purchase_request)
+        return purchase_request
+    
+    def url(self, action=None, purchase_request=None):
+        pk = (purchase_request or self.purchase_request).pk
+        return f'/api/requests/{pk}/{action}/' if action else f'/api/requests/{pk}/'
+    
+    def other_client(self, user):
+        client = APIClient()
+        client.force_authenticate(user)
+        return client
+    
+    @contextmanager
+    def decided_meanwhile(self, decide):
+        """Run decide() once, between a view's read of a request and its write"""
+        can_decide = PurchaseRequest.can_decide
+        pending = [decide]
+        
+        def interleaved(purchase_request, user):
+            allowed = can_decide(purchase_request, user)
+            if pending:
+                pending.pop()()
+            return allowed
+        
+        with mock.patch.object(PurchaseRequest, 'can_decide', interleaved):
+            yield
+    
+    def assertConflict(self, response, **current):
+        self.assertEqual(response.status_code, 409)
+        for field, value in current.items():
+            self.assertEqual(response.json()['request'][field], value)
+    
+    def test_stale_version_is_refused(self):
+        # The creator edits the request after the approver loaded it
+        self.other_client(self.staff).put(self.url(), {'amount': '120.00', 'version': 0})
+        rollups = spend_rollups()
+        
+        self.assertConflict(
+            self.client.patch(self.url('approve'), {'version': 0}), version=1, status='pending'
+        )
+        self.assertConflict(
+            self.client.patch(self.url('reject'), {'version': 0, 'reason': 'Too expensive'}),
+            version=1, status='pending'
+        )
+        self.assertConflict(
+            self.other_client(self.staff).put(self.url(), {'amount': '90.00', 'version': 0}),
+            version=1, amount='120.00'
+        )
+        self.assertEqual(ApprovalStep.objects.get(level=1).status, 'pending')
+        self.assertEqual(spend_rollups(), rollups)
+        
+        response = self.client.patch(self.url('approve'), {'version': 1})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['request']['version'], 2)
+    
+    def test_racing_decisions_have_one_winner(self):
+        rival = self.other_client(self.other_approver)
+        with self.decided_meanwhile(lambda: rival.patch(self.url('reject'), {'reason': 'Duplicate'})):
+            response = self.client.patch(self.url('approve'))
+        
+        self.assertConflict(response, status='rejected')
+        step = ApprovalStep.objects.get(level=1)
+        self.assertEqual((step.status, step.decided_by), ('rejected', self.other_approver))
+        self.assertEqual(spend_rollups(), rebuilt_spend_rollups())
+    
+    def test_bulk_decision_skips_requests_changed_meanwhile(self):
+        other = self.create_request('Desks')
+        rival = self.other_client(self.other_approver)
+        with self.decided_meanwhile(lambda: rival.patch(self.url('reject'), {'reason': 'Duplicate'})):
+            response = self.client.post(
+                '/api/requests/bulk_approve/', {'ids': [self.purchase_request.pk, other.pk]}, format='json'
+            )
+        
+        results = {result['id']: result for result in response.json()['results']}
+        self.assertEqual(results[self.purchase_request.pk]['error'], 'Request was changed by someone else')
+        self.assertTrue(results[other.pk]['success'])
+        self.assertEqual(
+            dict(ApprovalStep.objects.filter(level=1).values_list('purchase_request_id', 'status')),
+            {self.purchase_request.pk: 'rejected', other.pk: 'approved'}
+        )
+        self.assertEqual(spend_rollups(), rebuilt_spend_rollups())
+
+class SpendRollupTests(APITestCase):
+    """The rollups kept up to date by each change equal a rebuild from the requests"""
+    
+    @classmethod
+    def setUpTestData(cls):
+        cls.staff = User.objects.create_user('staff', password='x', role='staff')
+        cls.level_1 = User.objects.create_user('approver1', password='x', role='approver_level_1')
+        cls.level_2 = User.objects.create_user('approver2', password='x', role='approver_level_2')
+    
+    def as_user(self, user):
+        self.client.force_authenticate(user)
+        return self.client
+    
+    def assertRollupsMatchRebuild(self, change):
+        with self.subTest(change):
+            self.assertEqual(spend_rollups(), rebuilt_spend_rollups())
+    
+    def test_rollups_match_a_rebuild_after_every_change(self):
+        ids = []
+        for title in ('Chairs', 'Desks', 'Lamps', 'Pens', 'Mugs'):
+            response = self.as_user(self.staff).post(
+                '/api/requests/', {'title': title, 'description': 'Office supplies', 'amount': '100.00'}
+            )
+            ids.append(response.json()['id'])
+        self.assertRollupsMatchRebuild('create')
+        
+        self.as_user(self.staff).put(f'/api/requests/{ids[0]}/', {'amount': '250.00'})
+        self.assertRollupsMatchRebuild('update amount')
+        
+        PurchaseRequest.objects.filter(pk=ids[0]).update(proforma='proformas/chairs.pdf')
+        job = DocumentJob.objects.create(purchase_request_id=ids[0], kind='proforma', file_name='proformas/chairs.pdf')
+        complete_job(job, {'vendor': 'Old Vendor'})
+        self.assertRollupsMatchRebuild('extraction')
+        
+        store_reextracted([(ids[0], 'proforma', 'proformas/chairs.pdf', {'vendor': 'New Vendor'})])
+        self.assertRollupsMatchRebuild('reextraction')
+        
+        self.as_user(self.level_1).patch(f'/api/requests/{ids[0]}/approve/')
+        self.as_user(self.level_2).patch(f'/api/requests/{ids[0]}/approve/')
+        self.assertRollupsMatchRebuild('approve')
+        
+        self.as_user(self.level_1).patch(f'/api/requests/{ids[1]}/reject/', {'reason': 'Duplicate'})
+        self.assertRollupsMatchRebuild('reject')
+        
+        self.as_user(self.staff).delete(f'/api/requests/{ids[2]}/')
+        self.assertRollupsMatchRebuild('delete')
+        
+        self.as_user(self.level_1).post('/api/requests/bulk_approve/', {'ids': ids[3:]}, format='json')
+        self.assertRollupsMatchRebuild('bulk approve')
+        
+        self.as_user(self.level_2).post(
+            '/api/requests/bulk_reject/', {'ids': ids[3:], 'reason': 'Over budget'}, format='json'
+        )
+        self.assertRollupsMatchRebuild('bulk reject')
+        
+        self.assertEqual(
+            dict(PurchaseRequest.objects.values_list('title', 'status')),
+            {'Chairs': 'approved', 'Desks': 'rejected', 'Pens': 'rejected', 'Mugs': 'rejected'}
+        )
+
+class DocumentJobTests(TestCase):
+    
+    def test_completed_extraction_makes_earlier_reads_stale(self):
+        staff = User.objects.create_user('staff', password='x', role='staff')
+        approver = User.objects.create_user('approver', password='x', role='approver_level_1')
+        purchase_request = PurchaseRequest.objects.create(
+            title='First', description='Office supplies', amount=100, created_by=staff,
+            proforma='proformas/first.pdf'
+        )
+        on_request_created(purchase_request)
+        job = DocumentJob.objects.create(
+            purchase_request=purchase_request, kind='proforma', file_name='proformas/first.pdf'
+        )
+        client = APIClient()
+        client.force_authenticate(approver)
+        version = client.get(f'/api/requests/{purchase_request.pk}/').json()['version']
+        
+        # The vendor, and with it the request's spend bucket, changes under the approver
+        complete_job(job, {'vendor': 'ACME Office Supplies', 'total_amount': 100.0})
+        response = client.patch(f'/api/requests/{purchase_request.pk}/approve/', {'version': version})
+        self.assertEqual(response.status_code, 409)
+        
+        response = client.patch(f'/api/requests/{purchase_request.pk}/approve/', {'version': version + 1})
+        self.assertEqual(response.status_code, 200)
+
+    
+    def test_reextraction_makes_earlier_reads_stale(self):
+        staff = User.objects.create_user('staff', password='x', role='staff')
+        approver = User.objects.create_user('approver', password='x', role='approver_level_1')
+        purchase_request = PurchaseRequest.objects.create(
+            title='First', description='Office supplies', amount=100, created_by=staff,
+            proforma='proformas/first.pdf', proforma_data={'vendor': 'Old Vendor'}
+        )
+        on_request_created(purchase_request)
+        client = APIClient()
+        client.force_authenticate(approver)
+        version = client.get(f'/api/requests/{purchase_request.pk}/').json()['version']
+        
+        store_reextracted([(purchase_request.pk, 'proforma', 'proformas/first.pdf', {'vendor': 'New Vendor'})])
+        response = client.patch(
+            f'/api/requests/{purchase_request.pk}/reject/', {'version': version, 'reason': 'Too expensive'}
+        )
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(response.json()['request']['status'], 'pending')
+
+class HealthTests(TestCase):
+    
+    def test_database_errors_are_logged_not_returned(self):
+        error = OperationalError('password authentication failed for user "procure"')
+        with mock.patch.object(connections['default'], 'cursor', side_effect=error):
+            with self.assertLogs('api.views', 'ERROR') as logs:
+                response = self.client.get('/health/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response.json(), {'status': 'unavailable'})
+        self.assertIn('password authentication failed', logs.output[0])
+
+class MetricsTests(TestCase):
+    
+    def test_metrics_need_the_token(self):
+        with override_settings(METRICS_TOKEN=''):
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer ').status_code, 404)
+        with override_settings(METRICS_TOKEN='scrape-secret'):
+            self.assertEqual(self.client.get('/metrics/').status_code, 404)
+            self.assertEqual(self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer guess').status_code, 404)
+            response = self.client.get('/metrics/', HTTP_AUTHORIZATION='Bearer scrape-secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'procure_instrumentation_sample_rate', response.content)
+    
+    def test_no_server_timing_by_default(self):
+        self.assertNotIn('Server-Timing', self.client.get('/health/'))
+
+class ChunkedUploadTests(APITestCase):
+    
+    def setUp(self):
+        staging = tempfile.TemporaryDirectory()
+        self.addCleanup(staging.cleanup)
+        staging_setting = override_settings(UPLOAD_STAGING_DIR=staging.name)
+        staging_setting.enable()
+        self.addCleanup(staging_setting.disable)
+        self.staging_dir = staging.name
+        self.user = User.objects.create_user('staff', password='x', role='staff')
+        self.client.force_authenticate(self.user)
+    
+    def put_chunk(self, upload_id, offset, data, checksum=None):
+        return self.client.generic(
+            'PUT', f'/api/uploads/{upload_id}/', data, content_type='application/offset+octet-stream',
+            HTTP_UPLOAD_OFFSET=str(offset), HTTP_UPLOAD_CHECKSUM=checksum or hashlib.sha256(data).hexdigest()
+        )
+    
+    def test_upload_in_chunks(self):
+        upload_id = self.client.post('/api/uploads/', {'file_name': 'scan.pdf', 'size': 8}).json()['id']
+        self.assertEqual(self.put_chunk(upload_id, 0, b'%PDF', checksum='0' * 64).status_code, 400)
+        self.assertEqual(self.put_chunk(upload_id, 0, b'%PDF').json()['offset'], 4)
+        
+        response = self.put_chunk(upload_id, 0, b'%PDF')
+        self.assertEqual((response.status_code, response.json()['offset']), (409, 4))
+        self.assertEqual(self.put_chunk(upload_id, 4, b'-1.4').json()['offset'], 8)
+        
+        upload = ChunkedUpload.objects.get()
+        with open(upload.staging_path, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF-1.4')
+        self.assertEqual(os.listdir(self.staging_dir), [os.path.basename(upload.staging_path)])
+    
+    def test_racing_chunks_at_one_offset_apply_once(self):
+        upload = ChunkedUpload.objects.create(user=self.user, file_name='scan.pdf', size=8)
+        # Both requests read the upload at offset 0 before either appended
+        first, second = ChunkedUpload.objects.get(), ChunkedUpload.objects.get()
+        append_chunk(first, io.BytesIO(b'%PDF'), 0, 4, hashlib.sha256(b'%PDF').hexdigest())
+        with self.assertRaises(ChunkError) as raised:
+            append_chunk(second, io.BytesIO(b'XXXX'), 0, 4, hashlib.sha256(b'XXXX').hexdigest())
+        
+        self.assertEqual(raised.exception.status, 409)
+        self.assertEqual(second.offset, 4)
+        with open(upload.staging_path, 'rb') as f:
+            self.assertEqual(f.read(), b'%PDF')
+        self.assertEqual(os.listdir(self.staging_dir), [os.path.basename(upload.staging_path)])
+
+class ReceiptMatchingTests(TestCase):
+    purchase_order = {
+        'vendor': 'ACME Office Supplies',
+        'total_amount': '150.00',
+        'items': ['Desk lamp 2 x 25.00 50.00', 'Office chair 1 x 100.00 100.00'],
+    }
+    
+    def test_line_items_are_reported_without_failing_the_receipt(self):
+        receipt = {
+            'vendor': 'ACME Office Supplies',
+            'amount': 150.0,
+            'items': ['Qty Description Price 0.00', 'Office chair 1 x 100.00 100.00'],
+        }
+        result = match_receipt(receipt, self.purchase_order, VendorIndex())
+        self.assertTrue(result['is_valid'])
+        self.assertEqual(result['discrepancies'], [])
+        self.assertEqual(result['line_discrepancies'], [
+            "Missing from receipt: 'Desk lamp 2 x 25.00 50.00'",
+            "Not on PO: 'Qty Description Price 0.00'",
+        ])
+    
+    def test_amount_mismatch_fails_the_receipt(self):
+        receipt = {'vendor': 'ACME Office Supplies', 'amount': 120.0, 'items': self.purchase_order['items']}
+        result = match_receipt(receipt, self.purchase_order, VendorIndex())
+        self.assertFalse(result['is_valid'])
+        self.assertEqual(result['discrepancies'], ['Amount mismatch: PO=$150.00 vs Receipt=$120.00'])
+
+class ExtractionCacheTests(TestCase):
+    
+    def test_size_is_only_checked_every_sixteenth_of_the_budget(self):
+        store = DatabaseStore(max_bytes=1600)
+        payload = 'x' * 48  # 50 bytes once JSON encoded
+        with self.assertNumQueries(1):
+            store.set('text-1-a', payload)
+        # The second 50 bytes reach 100, 1/16 of the budget: one size check
+        with self.assertNumQueries(2):
+            store.set('text-1-b', payload)
+        
+        for i in range(60):
+            store.set(f'text-1-{i}', payload)
+        total = sum(ExtractionCacheEntry.objects.values_list('size', flat=True))
+        self.assertLessEqual(total, 1600 + 100)
+        self.assertEqual(store.get('text-1-59'), payload)
+
+class ProformaExtractionTests(TestCase):
+    
+    def test_reads_on_until_the_labelled_total(self):
+        # Page 1 has unlabelled prices, a vendor block and "Proforma Invoice";
+        # the vendor label, invoice number and total are on page 2.
+        data = extract_proforma_data(TEST_DOCUMENTS / 'proforma_two_pages.pdf')
+        self.assertEqual(data['total_amount'], 14400.0)
+    
+    def test_failed_ocr_is_not_cached(self):
+        scanned = TEST_DOCUMENTS / 'scanned_page.pdf'
+        with mock.patch('api.document_processor.ocr_image', return_value=None):
+            self.assertEqual(extract_proforma_data(scanned)['total_amount'], 0.0)
+        
+        page_text = 'Vendor: ACME Office Supplies\nTotal: $50.00'
+        with mock.patch('api.document_processor.ocr_image', return_value=page_text) as ocr:
+            self.assertEqual(extract_proforma_data(scanned)['total_amount'], 50.0)
+            self.assertEqual(extract_proforma_data(scanned)['total_amount'], 50.0)
+        self.assertEqual(ocr.call_count, 1)
@@ -0,0 +1,123 @@
+import glob
+import hashlib
+import os
+import shutil
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.files import File
+from django.db import transaction
+from django.utils import timezone
+
+from .models import ChunkedUpload
+
+READ_SIZE = 64 * 1024
+
+class ChunkError(Exception):
+    """A chunk that was not appended; `status` is the HTTP status to answer with"""
+
+    def __init__(self, message, status=400):
+        super().__init__(message)
+        self.status = status
+
+class StagedFile(File):
+    """A completed upload. FileSystemStorage moves it into place via
+    temporary_file_path() instead of copying it."""
+
+    def __init__(self, upload):
+        super().__init__(open(upload.staging_path, 'rb'), name=upload.file_name)
+        self.upload = upload
+
+    def temporary_file_path(self):
+        return self.upload.staging_path
+
+def append_chunk(upload, stream, offset, length, checksum):
+    """Append `length` bytes from `stream` at `offset` of the staged file.
+
+    The chunk is read a block at a time into a file of its own and checked
+    against its SHA-256. Only then is it claimed, by moving the upload's offset
+    with an UPDATE conditional on `offset`. Of two PUTs at the same offset, one
+    wins and the other gets 409 without touching the staged file. That holds
+    without row locks (SQLite). The winner copies its chunk in before the claim
+    commits, so a failed copy undoes the claim and the next chunk's claim
+    waits for it."""
+    if offset != upload.offset:
+        raise ChunkError(f'Expected offset {upload.offset}', status=409)
+    if length <= 0:
+        raise ChunkError('Empty chunk')
+    if length > settings.UPLOAD_MAX_CHUNK_BYTES:
+        raise ChunkError(f'Chunks are limited to {settings.UPLOAD_MAX_CHUNK_BYTES} bytes', status=413)
+    if offset + length > upload.size:
+        raise ChunkError('Chunk runs past the declared size')
+
+    os.makedirs(settings.UPLOAD_STAGING_DIR, exist_ok=True)
+    chunk_path = f'{upload.staging_path}.{uuid.uuid4().hex}'
+    try:
+        digest = hashlib.sha256()
+        received = 0
+        with open(chunk_path, 'wb') as chunk:
+            while received < length:
+                block = stream.read(min(READ_SIZE, length - received))
+                if not block:
+                    break
+                chunk.write(block)
+                digest.update(block)
+                received += len(block)
+        if received != length:
+            raise ChunkError(f'Chunk ended after {received} of {length} bytes')
+        if digest.hexdigest() != checksum.lower():
+            raise ChunkError('Chunk checksum mismatch')
+
+        now = timezone.now()
+        with transaction.atomic():
+            claimed = ChunkedUpload.objects.filter(pk=upload.pk, offset=offset).update(
+                offset=offset + length, updated_at=now
+            )
+            if not claimed:
+                current = ChunkedUpload.objects.filter(pk=upload.pk).values_list('offset', flat=True).first()
+                if current is None:
+                    raise ChunkError('Upload not found', status=404)
+                upload.offset = current
+                raise ChunkError(f'Expected offset {upload.offset}', status=409)
+            with open(chunk_path, 'rb') as chunk, open(upload.staging_path, 'r+b' if offset else 'wb') as f:
+                f.seek(offset)
+                f.truncate()
+                shutil.copyfileobj(chunk, f, READ_SIZE)
+    finally:
+        try:
+            os.remove(chunk_path)
+        except FileNotFoundError:
+            pass
+
+    upload.offset = offset + length
+    upload.updated_at = now
+    return upload
+
+def staged_file(upload):
+    return StagedFile(upload)
+
+def discard_upload(upload):
+    """Delete an upload's row and whatever is left of its staged file and chunks"""
+    for path in [upload.staging_path, *glob.glob(glob.escape(upload.staging_path) + '.*')]:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    upload.delete()
+
+def purge_stale_uploads(max_age=None):
+    """Discard uploads untouched for `max_age` seconds (UPLOAD_EXPIRY_SECONDS by default)"""
+    if max_age is None:
+        max_age = settings.UPLOAD_EXPIRY_SECONDS
+    cutoff = timezone.now() - timedelta(seconds=max_age)
+    stale = list(ChunkedUpload.objects.filter(updated_at__lt=cutoff))
+    for upload in stale:
+        discard_upload(upload)
+    return len(stale)
+
+def release_staged(file):
+    """Once a StagedFile has been saved into a FileField, drop its upload"""
+    if isinstance(file, StagedFile):
+        file.close()
+        discard_upload(file.upload)
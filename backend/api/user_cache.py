@@ -0,0 +1,151 @@
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import router
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+from django.utils.module_loading import import_string
+
+from .models import User
+
+# Enough for authentication, the role checks in the views and UserSerializer.
+# Anything else is left deferred and loaded from the database on access.
+CACHED_USER_FIELDS = [
+    'id', 'username', 'email', 'first_name', 'last_name', 'role',
+    'is_active', 'is_staff', 'is_superuser',
+]
+
+class UserCache:
+    """Base class for authenticated-user caches, with per-process hit/miss counters"""
+
+    def __init__(self, ttl, location=None, max_entries=None):
+        self.ttl = ttl
+        self.location = location
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, user_id):
+        values = self._get(user_id)
+        with self._lock:
+            if values is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return values
+
+    def set(self, user_id, values):
+        self._set(user_id, values)
+
+    def delete(self, user_id):
+        self._delete(user_id)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _get(self, user_id):
+        raise NotImplementedError
+
+    def _set(self, user_id, values):
+        raise NotImplementedError
+
+    def _delete(self, user_id):
+        raise NotImplementedError
+
+class LocMemUserCache(UserCache):
+    """Keeps entries in this process; other processes only see a change after the TTL"""
+
+    def __init__(self, ttl, location=None, max_entries=None):
+        super().__init__(ttl, location, max_entries)
+        self._entries = {}
+
+    def _get(self, user_id):
+        entry = self._entries.get(user_id)
+        if entry is None or entry[0] < time.monotonic():
+            return None
+        return entry[1]
+
+    def _set(self, user_id, values):
+        with self._lock:
+            if self.max_entries and len(self._entries) >= self.max_entries:
+                now = time.monotonic()
+                self._entries = {
+                    key: entry for key, entry in self._entries.items() if entry[0] >= now
+                }
+                while len(self._entries) >= self.max_entries:
+                    # Oldest insertion first
+                    del self._entries[next(iter(self._entries))]
+            self._entries[user_id] = (time.monotonic() + self.ttl, values)
+
+    def _delete(self, user_id):
+        with self._lock:
+            self._entries.pop(user_id, None)
+
+class DjangoCacheUserCache(UserCache):
+    """Stores entries in the CACHES alias named by LOCATION, shared by every process using it"""
+
+    def _key(self, user_id):
+        return f"auth-user-{user_id}"
+
+    def _get(self, user_id):
+        return caches[self.location or 'default'].get(self._key(user_id))
+
+    def _set(self, user_id, values):
+        caches[self.location or 'default'].set(self._key(user_id), values, self.ttl)
+
+    def _delete(self, user_id):
+        caches[self.location or 'default'].delete(self._key(user_id))
+
+_cache = None
+_cache_lock = threading.Lock()
+
+def get_user_cache():
+    """Return the configured cache, built once per process from settings.USER_CACHE"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = settings.USER_CACHE
+                _cache = import_string(config['BACKEND'])(
+                    ttl=config['TTL'],
+                    location=config.get('LOCATION'),
+                    max_entries=config.get('MAX_ENTRIES'),
+                )
+    return _cache
+
+def get_cached_user(user_id):
+    """Return the user with this id, or None, reading the database only on a cache miss"""
+    cache = get_user_cache()
+    values = cache.get(user_id)
+    if values is None:
+        values = User.objects.filter(pk=user_id).values(*CACHED_USER_FIELDS).first()
+        if values is None:
+            return None
+        cache.set(user_id, values)
+
+    # from_db() expects the values in model field order
+    field_names = [
+        field.attname for field in User._meta.concrete_fields
+        if field.attname in values
+    ]
+    return User.from_db(
+        router.db_for_read(User),
+        field_names,
+        [values[name] for name in field_names],
+    )
+
+@receiver(post_save, sender=User)
+@receiver(post_delete, sender=User)
+def invalidate_cached_user(sender, instance, **kwargs):
+    # Role changes, deactivation and deletion must not wait for the TTL.
+    # QuerySet.update() sends no signal, so it has to call this itself.
+    get_user_cache().delete(instance.pk)
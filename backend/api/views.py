@@ -1,20 +1,52 @@
+import hashlib
+import hmac
+import logging
+from collections import defaultdict
+
 from rest_framework import viewsets, status
 from rest_framework.decorators import action, api_view, permission_classes
 from rest_framework.response import Response
+from rest_framework.exceptions import AuthenticationFailed
 from rest_framework.permissions import IsAuthenticated, AllowAny
+from rest_framework.renderers import JSONRenderer
 from rest_framework_simplejwt.tokens import RefreshToken
-from django.db import transaction
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Count, Max
+import asyncio
+
+from asgiref.sync import sync_to_async
+from django.http import HttpResponse, HttpResponseNotAllowed, JsonResponse, StreamingHttpResponse
+from django.shortcuts import get_object_or_404
 from django.utils import timezone
-from .models import User, PurchaseRequest
+from django.utils.cache import get_conditional_response, patch_cache_control, patch_vary_headers
+from django.utils.dateparse import parse_date
+from django.utils.http import http_date
+from procure_to_pay.database import read_replica
+from .models import User, PurchaseRequest, ApprovalStep, ChunkedUpload
 from .serializers import (
     UserSerializer, RegisterSerializer, PurchaseRequestSerializer,
     PurchaseRequestCreateSerializer, ApprovalSerializer, 
-    RejectionSerializer, ReceiptUploadSerializer
+    RejectionSerializer, ReceiptUploadSerializer, TransitionSerializer,
+    BulkApprovalSerializer, BulkRejectionSerializer, ChunkedUploadSerializer
 )
-from .document_processor import (
-    extract_proforma_data, generate_purchase_order, validate_receipt
+from .analytics import GROUP_BY_FIELDS, bucket_for, record_spend_changes, spend_summary
+from .document_processor import validate_receipt
+from .downloads import DocumentRenderer, document_response
+from .authentication import CachedJWTAuthentication
+from .events import publish_request_events, request_state, stream_request_events
+from .instrumentation import render_metrics
+from .exports import export_rows, stream_csv, stream_ndjson
+from .pagination import KeysetPagination
+from .uploads import ChunkError, append_chunk, discard_upload, release_staged
+from .workflow import approver_roles, decide
+from .tasks import (
+    enqueue_proforma_extraction, enqueue_purchase_orders, file_source,
+    get_extraction_process_pool, validate_receipt_source
 )
 
+logger = logging.getLogger(__name__)
+
 @api_view(['POST'])
 @permission_classes([AllowAny])
 def register(request):
@@ -35,24 +67,324 @@ def current_user(request):
     serializer = UserSerializer(request.user)
     return Response(serializer.data)
 
+def health(request):
+    """Liveness and database check for load balancers and container health checks.
+    The response is unauthenticated, so why a database failed is only logged."""
+    healthy = True
+    for alias in settings.DATABASES:
+        try:
+            with connections[alias].cursor() as cursor:
+                cursor.execute('SELECT 1')
+        except Exception:
+            logger.exception("Health check failed for database %r", alias)
+            healthy = False
+    return JsonResponse(
+        {'status': 'ok' if healthy else 'unavailable'},
+        status=200 if healthy else 503
+    )
+
+def metrics(request):
+    """Prometheus metrics of this process; only served to scrapers sending METRICS_TOKEN"""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    expected = f'Bearer {settings.METRICS_TOKEN}'
+    if not settings.METRICS_TOKEN or not hmac.compare_digest(
+        request.META.get('HTTP_AUTHORIZATION', '').encode(), expected.encode()
+    ):
+        return HttpResponse(status=404)
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
+@api_view(['GET'])
+@permission_classes([IsAuthenticated])
+def spend_analytics(request):
+    """Spend totals read from the rollup table, grouped by ?group_by=month,status,vendor,created_by.
+    Staff get only their own spend. Finance and approvers get company-wide
+    totals on purpose, including requests outside their queue, so approvers
+    can weigh a request against its vendor's and creator's history."""
+    params = request.query_params
+    group_by = [name.strip() for name in params.get('group_by', 'month,status').split(',') if name.strip()]
+    unknown = [name for name in group_by if name not in GROUP_BY_FIELDS]
+    if unknown:
+        return Response(
+            {'error': f"Cannot group by {', '.join(unknown)}; choose from {', '.join(GROUP_BY_FIELDS)}"},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    months = {}
+    for param in ('from', 'to'):
+        value = params.get(param)
+        if not value:
+            continue
+        try:
+            month = parse_date(f'{value}-01')
+        except ValueError:
+            month = None
+        if month is None:
+            return Response(
+                {'error': f'{param} must be a month (YYYY-MM)'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        months[param] = month
+    
+    statuses = params.get('status')
+    results = spend_summary(
+        request.user,
+        group_by,
+        statuses=statuses.split(',') if statuses else None,
+        month_from=months.get('from'),
+        month_to=months.get('to'),
+    )
+    return Response({'group_by': group_by, 'results': results})
+
+async def authenticate_async(request):
+    """Authenticate a plain async view the way the API does; returns (user, error response)"""
+    try:
+        auth = await sync_to_async(CachedJWTAuthentication().authenticate)(request)
+    except AuthenticationFailed as e:
+        detail = e.detail if isinstance(e.detail, dict) else {'detail': e.detail}
+        return None, JsonResponse(detail, status=401)
+    if auth is None:
+        return None, JsonResponse({'detail': 'Authentication credentials were not provided.'}, status=401)
+    return auth[0], None
+
+async def save_upload(field_name, upload):
+    """Write an uploaded file to the field's storage off the event loop; returns the stored name"""
+    field = PurchaseRequest._meta.get_field(field_name)
+    name = field.generate_filename(None, upload.name)
+    return await sync_to_async(field.storage.save, thread_sensitive=False)(
+        name, upload, max_length=field.max_length
+    )
+
+# Receipts are validated against the PO, which the document worker renders
+# some time after final approval
+PO_PENDING_ERROR = 'The purchase order is still being generated, submit the receipt once it is ready'
+
+def on_request_created(purchase_request):
+    """Side effects of a new request; run inside the creating transaction"""
+    purchase_request.plan_approval()
+    record_spend_changes([(None, (bucket_for(purchase_request), purchase_request.amount))])
+    publish_request_events([('created', purchase_request, None)])
+    
+    if purchase_request.proforma:
+        enqueue_proforma_extraction(purchase_request)
+
+async def request_events(request):
+    """Server-Sent Events feed of create/approve/reject changes to the user's queue.
+    Needs an ASGI server; under WSGI each open feed holds a worker."""
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    
+    user, error = await authenticate_async(request)
+    if error:
+        return error
+    
+    response = StreamingHttpResponse(stream_request_events(user), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+async def create_request_async(request):
+    """Async POST /api/requests/: the proforma is written off the event loop and
+    the row is created through sync_to_async"""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    user, error = await authenticate_async(request)
+    if error:
+        return error
+    if user.role != 'staff':
+        return JsonResponse({'error': 'Only staff can create purchase requests'}, status=403)
+    
+    request.user = user
+    data = request.POST.dict()
+    data.update(request.FILES.dict())
+    serializer = PurchaseRequestCreateSerializer(data=data, context={'request': request})
+    # Validating proforma_upload reads the database
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=400)
+    
+    fields = dict(serializer.validated_data)
+    proforma = fields.pop('proforma', None)
+    purchase_request = PurchaseRequest(created_by=user, **fields)
+    if proforma:
+        purchase_request.proforma.name = await save_upload('proforma', proforma)
+        await sync_to_async(release_staged)(proforma)
+    
+    @sync_to_async
+    def create():
+        with transaction.atomic():
+            purchase_request.save()
+            on_request_created(purchase_request)
+        return PurchaseRequestSerializer(purchase_request).data
+    
+    return JsonResponse(await create(), status=201)
+
+async def submit_receipt_async(request, pk):
+    """Async POST /api/requests/{id}/submit_receipt/: the receipt is written off the
+    event loop and validated on the extraction process pool"""
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    
+    user, error = await authenticate_async(request)
+    if error:
+        return error
+    
+    purchase_request = await PurchaseRequest.objects.visible_to(user).filter(pk=pk).afirst()
+    if purchase_request is None:
+        return JsonResponse({'detail': 'Not found.'}, status=404)
+    if purchase_request.created_by_id != user.pk:
+        return JsonResponse({'error': 'Only the request creator can submit receipts'}, status=403)
+    if purchase_request.status != 'approved':
+        return JsonResponse({'error': 'Can only submit receipts for approved requests'}, status=400)
+    if not purchase_request.purchase_order_data:
+        return JsonResponse({'error': PO_PENDING_ERROR}, status=409)
+    
+    request.user = user
+    data = request.POST.dict()
+    data.update(request.FILES.dict())
+    serializer = ReceiptUploadSerializer(data=data, context={'request': request})
+    if not await sync_to_async(serializer.is_valid)():
+        return JsonResponse(serializer.errors, status=400)
+    
+    receipt = serializer.validated_data['receipt']
+    purchase_request.receipt.name = await save_upload('receipt', receipt)
+    await sync_to_async(release_staged)(receipt)
+    
+    try:
+        source = await sync_to_async(file_source, thread_sensitive=False)(
+            'receipt', purchase_request.receipt.name
+        )
+        purchase_request.receipt_validation = await asyncio.get_running_loop().run_in_executor(
+            get_extraction_process_pool(),
+            validate_receipt_source, source, purchase_request.purchase_order_data
+        )
+        purchase_request.receipt_data = purchase_request.receipt_validation['receipt_data']
+    except Exception as e:
+        purchase_request.receipt_validation = {
+            'is_valid': False,
+            'error': str(e)
+        }
+    
+    await purchase_request.asave(update_fields=['receipt', 'receipt_data', 'receipt_validation', 'updated_at'])
+    
+    @sync_to_async
+    def serialize():
+        return PurchaseRequestSerializer(purchase_request).data
+    
+    return JsonResponse({
+        'message': 'Receipt submitted successfully',
+        'validation': purchase_request.receipt_validation,
+        'request': await serialize()
+    })
+
+# csrf_exempt() would hide the coroutine from Django 4.2; these views
+# authenticate with the Authorization header, like the API views.
+create_request_async.csrf_exempt = True
+submit_receipt_async.csrf_exempt = True
+
 class PurchaseRequestViewSet(viewsets.ModelViewSet):
     queryset = PurchaseRequest.objects.all()
     serializer_class = PurchaseRequestSerializer
     permission_classes = [IsAuthenticated]
+    pagination_class = KeysetPagination
     
     def get_queryset(self):
-        user = self.request.user
-        queryset = PurchaseRequest.objects.all()
+        queryset = PurchaseRequest.objects.visible_to(self.request.user).select_related(
+            'created_by', 'rejected_by'
+        ).prefetch_related('approval_steps__decided_by')
+        if self.action == 'list':
+            # Queue polls tolerate replica lag; everything else reads the primary
+            queryset = queryset.using(read_replica())
         
-        if user.role == 'staff':
-            queryset = queryset.filter(created_by=user)
-        elif user.role == 'approver_level_1':
-            queryset = queryset.filter(status='pending')
-        elif user.role == 'approver_level_2':
-            queryset = queryset.filter(status='pending', level_1_approved=True)
+        fields = self.get_requested_fields()
+        if fields is not None:
+            skipped = [
+                name for name in PurchaseRequestSerializer.DOCUMENT_DATA_FIELDS
+                if name not in fields
+            ]
+            queryset = queryset.defer(*skipped)
         
         return queryset
     
+    def get_requested_fields(self):
+        """Fields picked with ?fields=a,b or ?compact=true on list and detail reads"""
+        if self.action not in ('list', 'retrieve'):
+            return None
+        
+        params = self.request.query_params
+        if params.get('fields'):
+            return [name.strip() for name in params['fields'].split(',') if name.strip()]
+        if params.get('compact', '').lower() in ('1', 'true', 'yes'):
+            return [
+                name for name in PurchaseRequestSerializer().fields
+                if name not in PurchaseRequestSerializer.DOCUMENT_DATA_FIELDS
+            ]
+        return None
+    
+    def get_serializer(self, *args, **kwargs):
+        fields = self.get_requested_fields()
+        if fields is not None:
+            kwargs['fields'] = fields
+        return super().get_serializer(*args, **kwargs)
+    
+    def get_validators(self, queryset):
+        """ETag and Last-Modified for a queryset, from one aggregate query.
+        Count and max id catch deletions and inserts that leave max
+        updated_at unchanged. Returns (None, None) for an empty queryset."""
+        state = queryset.order_by().aggregate(
+            last_modified=Max('updated_at'), last_id=Max('id'), count=Count('id')
+        )
+        if not state['count']:
+            return None, None
+        
+        user = self.request.user
+        key = '|'.join(str(part) for part in [
+            user.pk, user.role, self.request.get_full_path(),
+            state['last_modified'].isoformat(), state['last_id'], state['count'],
+        ])
+        etag = '"%s"' % hashlib.md5(key.encode(), usedforsecurity=False).hexdigest()
+        return etag, state['last_modified'].timestamp()
+    
+    def conditional_response(self, queryset, render, send_last_modified=True):
+        """Answer 304 when the client's copy is current, otherwise render() with validators.
+        Lists pass send_last_modified=False: max updated_at over a filtered queue
+        goes backwards when its newest row leaves, so only the ETag is safe there."""
+        etag, last_modified = self.get_validators(queryset)
+        if not send_last_modified:
+            last_modified = None
+        if etag is not None:
+            not_modified = get_conditional_response(
+                self.request, etag=etag, last_modified=last_modified
+            )
+            if not_modified is not None:
+                response = not_modified
+            else:
+                response = render()
+                response['ETag'] = etag
+                if last_modified is not None:
+                    response['Last-Modified'] = http_date(last_modified)
+        else:
+            response = render()
+        
+        # Browsers revalidate on every poll, and never share a user's queue.
+        patch_cache_control(response, private=True, no_cache=True)
+        patch_vary_headers(response, ['Authorization'])
+        return response
+    
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        return self.conditional_response(
+            queryset, lambda: super(PurchaseRequestViewSet, self).list(request, *args, **kwargs),
+            send_last_modified=False
+        )
+    
+    def retrieve(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset()).filter(pk=kwargs['pk'])
+        return self.conditional_response(
+            queryset, lambda: super(PurchaseRequestViewSet, self).retrieve(request, *args, **kwargs)
+        )
+    
     def get_serializer_class(self):
         if self.action == 'create':
             return PurchaseRequestCreateSerializer
@@ -67,15 +399,9 @@ class PurchaseRequestViewSet(viewsets.ModelViewSet):
         
         serializer = self.get_serializer(data=request.data)
         if serializer.is_valid():
-            purchase_request = serializer.save()
-            
-            if purchase_request.proforma:
-                try:
-                    proforma_data = extract_proforma_data(purchase_request.proforma)
-                    purchase_request.proforma_data = proforma_data
-                    purchase_request.save()
-                except Exception as e:
-                    pass
+            with transaction.atomic():
+                purchase_request = serializer.save()
+                on_request_created(purchase_request)
             
             return Response(
                 PurchaseRequestSerializer(purchase_request).data,
@@ -98,70 +424,89 @@ class PurchaseRequestViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
+        transition = TransitionSerializer(data=request.data)
+        if not transition.is_valid():
+            return Response(transition.errors, status=status.HTTP_400_BAD_REQUEST)
+        if self.is_stale(purchase_request, transition):
+            return self.conflict_response(pk)
+        
         serializer = PurchaseRequestCreateSerializer(
-            purchase_request, data=request.data, partial=True
+            purchase_request, data=request.data, partial=True, context={'request': request}
         )
         if serializer.is_valid():
-            purchase_request = serializer.save()
-            
-            if 'proforma' in request.data and purchase_request.proforma:
-                try:
-                    proforma_data = extract_proforma_data(purchase_request.proforma)
-                    purchase_request.proforma_data = proforma_data
-                    purchase_request.save()
-                except Exception as e:
-                    pass
+            before = (bucket_for(purchase_request), purchase_request.amount)
+            state = request_state(purchase_request)
+            with transaction.atomic():
+                # Claim the version read above, so an approval that lands
+                # meanwhile turns this edit into a conflict
+                if not purchase_request.apply_transition({}):
+                    return self.conflict_response(pk)
+                purchase_request = serializer.save()
+                record_spend_changes([(before, (bucket_for(purchase_request), purchase_request.amount))])
+                
+                if purchase_request.amount != before[1]:
+                    # Amount thresholds may add or drop approval levels
+                    purchase_request.replan_approval()
+                    if request_state(purchase_request) != state:
+                        publish_request_events([('updated', purchase_request, state)])
+                
+                new_proforma = 'proforma' in request.data or 'proforma_upload' in request.data
+                if new_proforma and purchase_request.proforma:
+                    enqueue_proforma_extraction(purchase_request)
             
             return Response(PurchaseRequestSerializer(purchase_request).data)
         return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
     
+    def perform_destroy(self, instance):
+        with transaction.atomic():
+            record_spend_changes([((bucket_for(instance), instance.amount), None)])
+            instance.delete()
+    
     @action(detail=True, methods=['patch'])
     def approve(self, request, pk=None):
         purchase_request = self.get_object()
         user = request.user
         
+        serializer = ApprovalSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if self.is_stale(purchase_request, serializer):
+            return self.conflict_response(pk)
+        
+        if purchase_request.status != 'pending':
+            return Response(
+                {'error': 'Request is not pending'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if not purchase_request.can_decide(user):
+            return Response(
+                {'error': 'You cannot approve this request at this stage'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        finished, step_changes = decide(purchase_request.approval_steps.all(), approve=True)
+        message = f'Level {step_changes[0][0].level} approval successful'
+        if finished:
+            message += ' - Request approved, purchase order is being generated'
+        
+        before = bucket_for(purchase_request)
+        state = request_state(purchase_request)
         with transaction.atomic():
-            purchase_request = PurchaseRequest.objects.select_for_update().get(pk=pk)
-            
-            if purchase_request.status != 'pending':
-                return Response(
-                    {'error': 'Request is not pending'},
-                    status=status.HTTP_400_BAD_REQUEST
-                )
-            
-            if user.role == 'approver_level_1' and not purchase_request.level_1_approved:
-                purchase_request.level_1_approved = True
-                purchase_request.level_1_approver = user
-                purchase_request.level_1_approved_at = timezone.now()
-                purchase_request.save()
-                
-                return Response({
-                    'message': 'Level 1 approval successful',
-                    'request': PurchaseRequestSerializer(purchase_request).data
-                })
-            
-            elif user.role == 'approver_level_2' and purchase_request.level_1_approved and not purchase_request.level_2_approved:
-                purchase_request.level_2_approved = True
-                purchase_request.level_2_approver = user
-                purchase_request.level_2_approved_at = timezone.now()
-                purchase_request.status = 'approved'
-                
-                po_data = generate_purchase_order(purchase_request)
-                purchase_request.purchase_order_data = po_data
-                
-                purchase_request.save()
-                
-                return Response({
-                    'message': 'Level 2 approval successful - Request approved and PO generated',
-                    'request': PurchaseRequestSerializer(purchase_request).data,
-                    'purchase_order': po_data
-                })
-            
-            else:
-                return Response(
-                    {'error': 'You cannot approve this request at this stage'},
-                    status=status.HTTP_403_FORBIDDEN
-                )
+            if not purchase_request.apply_transition({'status': 'approved'} if finished else {}):
+                return self.conflict_response(pk)
+            ApprovalStep.objects.move(step_changes, user, timezone.now())
+            record_spend_changes([
+                ((before, purchase_request.amount), (bucket_for(purchase_request), purchase_request.amount))
+            ])
+            publish_request_events([('approved', purchase_request, state)])
+            if purchase_request.status == 'approved':
+                enqueue_purchase_orders([purchase_request])
+        
+        return Response({
+            'message': message,
+            'request': PurchaseRequestSerializer(purchase_request).data
+        })
     
     @action(detail=True, methods=['patch'])
     def reject(self, request, pk=None):
@@ -171,32 +516,243 @@ class PurchaseRequestViewSet(viewsets.ModelViewSet):
         serializer = RejectionSerializer(data=request.data)
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        if self.is_stale(purchase_request, serializer):
+            return self.conflict_response(pk)
+        
+        if purchase_request.status != 'pending':
+            return Response(
+                {'error': 'Request is not pending'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        if user.role not in approver_roles():
+            return Response(
+                {'error': 'Only approvers can reject requests'},
+                status=status.HTTP_403_FORBIDDEN
+            )
         
+        if not purchase_request.can_decide(user):
+            return Response(
+                {'error': 'You cannot reject this request at this stage'},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        
+        _, step_changes = decide(purchase_request.approval_steps.all(), approve=False)
+        before = bucket_for(purchase_request)
+        state = request_state(purchase_request)
+        now = timezone.now()
         with transaction.atomic():
-            purchase_request = PurchaseRequest.objects.select_for_update().get(pk=pk)
-            
-            if purchase_request.status != 'pending':
+            if not purchase_request.apply_transition({
+                'status': 'rejected',
+                'rejected_by': user,
+                'rejected_at': now,
+                'rejection_reason': serializer.validated_data['reason'],
+            }):
+                return self.conflict_response(pk)
+            ApprovalStep.objects.move(step_changes, user, now)
+            record_spend_changes([
+                ((before, purchase_request.amount), (bucket_for(purchase_request), purchase_request.amount))
+            ])
+            publish_request_events([('rejected', purchase_request, state)])
+        
+        return Response({
+            'message': 'Request rejected',
+            'request': PurchaseRequestSerializer(purchase_request).data
+        })
+    
+    def is_stale(self, purchase_request, serializer):
+        """Whether the client acted on an older version of the request than the one read"""
+        version = serializer.validated_data.get('version')
+        return version is not None and version != purchase_request.version
+    
+    def conflict_response(self, pk):
+        """409 with the request as it is now, for a change someone else beat us to"""
+        current = get_object_or_404(
+            PurchaseRequest.objects.select_related('created_by', 'rejected_by')
+            .prefetch_related('approval_steps__decided_by'),
+            pk=pk
+        )
+        return Response({
+            'error': 'Request was changed by someone else, reload it and try again',
+            'request': PurchaseRequestSerializer(current).data
+        }, status=status.HTTP_409_CONFLICT)
+    
+    @action(
+        detail=True, methods=['get'], renderer_classes=[JSONRenderer, DocumentRenderer],
+        url_path=r'documents/(?P<kind>proforma|purchase_order|receipt)'
+    )
+    def document(self, request, pk=None, kind=None):
+        """Download a request's proforma, PO or receipt, for users who can see the request"""
+        purchase_request = self.get_object()
+        field_file = getattr(purchase_request, kind)
+        if not field_file:
+            return Response({'error': f'No {kind} has been stored'}, status=status.HTTP_404_NOT_FOUND)
+        return document_response(request, field_file)
+    
+    @action(detail=False, methods=['get'])
+    def export(self, request):
+        """Stream the user's requests as CSV or NDJSON (?output=csv|ndjson)"""
+        output = request.query_params.get('output', 'csv')
+        if output not in ('csv', 'ndjson'):
+            return Response(
+                {'error': 'output must be csv or ndjson'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        queryset = PurchaseRequest.objects.using(read_replica()).visible_to(request.user).order_by('created_at', 'id')
+        
+        statuses = request.query_params.get('status')
+        if statuses:
+            queryset = queryset.filter(status__in=statuses.split(','))
+        
+        for param, lookup in [('created_after', 'created_at__date__gte'), ('created_before', 'created_at__date__lte')]:
+            value = request.query_params.get(param)
+            if not value:
+                continue
+            try:
+                date = parse_date(value)
+            except ValueError:
+                date = None
+            if date is None:
                 return Response(
-                    {'error': 'Request is not pending'},
+                    {'error': f'{param} must be a date (YYYY-MM-DD)'},
                     status=status.HTTP_400_BAD_REQUEST
                 )
+            queryset = queryset.filter(**{lookup: date})
+        
+        rows = export_rows(queryset)
+        if output == 'csv':
+            response = StreamingHttpResponse(stream_csv(rows), content_type='text/csv')
+        else:
+            response = StreamingHttpResponse(stream_ndjson(rows), content_type='application/x-ndjson')
+        response['Content-Disposition'] = f'attachment; filename="purchase_requests.{output}"'
+        return response
+    
+    def _bulk_transition(self, ids, apply, event_type, now):
+        """Apply a transition to each visible request without locking them: one
+        conditional UPDATE per group of requests at the same version making the
+        same change, and one per request in a group someone else changed first.
+        apply(request) returns (error, request changes, step changes); the step
+        changes of all requests are written with one UPDATE per step status.
+        Returns a result per id."""
+        ids = sorted(set(ids))
+        results = {pk: {'id': pk, 'success': False, 'error': 'Request not found'} for pk in ids}
+        
+        # Within one call the same change always writes the same values, so the
+        # changed fields and the version identify a group.
+        groups = defaultdict(list)
+        requests = (
+            PurchaseRequest.objects.visible_to(self.request.user)
+            .filter(pk__in=ids)
+            .prefetch_related('approval_steps')
+        )
+        for purchase_request in requests:
+            error, changes, step_changes = apply(purchase_request)
+            if error:
+                results[purchase_request.pk]['error'] = error
+                continue
+            groups[(purchase_request.version, tuple(changes))].append((purchase_request, changes, step_changes))
+        
+        with transaction.atomic():
+            changed = []
+            step_changes = []
+            spend_changes = []
+            events = []
+            for (version, _), members in sorted(groups.items()):
+                changes = dict(members[0][1], updated_at=now)
+                savepoint = transaction.savepoint()
+                written = PurchaseRequest.objects.filter(
+                    pk__in=[member[0].pk for member in members]
+                ).transition(version, changes)
+                if written == len(members):
+                    transaction.savepoint_commit(savepoint)
+                else:
+                    transaction.savepoint_rollback(savepoint)
+                    won = []
+                    for member in members:
+                        if PurchaseRequest.objects.filter(pk=member[0].pk).transition(version, changes):
+                            won.append(member)
+                        else:
+                            results[member[0].pk]['error'] = 'Request was changed by someone else'
+                    members = won
+                
+                for purchase_request, _, request_step_changes in members:
+                    before = bucket_for(purchase_request)
+                    state = request_state(purchase_request)
+                    for field, value in changes.items():
+                        setattr(purchase_request, field, value)
+                    purchase_request.version += 1
+                    changed.append(purchase_request)
+                    step_changes.extend(request_step_changes)
+                    spend_changes.append((
+                        (before, purchase_request.amount),
+                        (bucket_for(purchase_request), purchase_request.amount)
+                    ))
+                    events.append((event_type, purchase_request, state))
+                    results[purchase_request.pk] = {
+                        'id': purchase_request.pk,
+                        'success': True,
+                        'status': purchase_request.status,
+                    }
             
-            if user.role not in ['approver_level_1', 'approver_level_2']:
-                return Response(
-                    {'error': 'Only approvers can reject requests'},
-                    status=status.HTTP_403_FORBIDDEN
-                )
+            if changed:
+                ApprovalStep.objects.move(step_changes, self.request.user, now)
+                record_spend_changes(spend_changes)
+                publish_request_events(events)
+                enqueue_purchase_orders([
+                    purchase_request for purchase_request in changed
+                    if purchase_request.status == 'approved'
+                ])
+        
+        return Response({'results': [results[pk] for pk in ids]})
+    
+    @action(detail=False, methods=['post'])
+    def bulk_approve(self, request):
+        serializer = BulkApprovalSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        user = request.user
+        now = timezone.now()
+        
+        def approve(purchase_request):
+            if not purchase_request.can_decide(user):
+                if purchase_request.status != 'pending':
+                    return 'Request is not pending', {}, []
+                return 'You cannot approve this request at this stage', {}, []
             
-            purchase_request.status = 'rejected'
-            purchase_request.rejected_by = user
-            purchase_request.rejected_at = timezone.now()
-            purchase_request.rejection_reason = serializer.validated_data['reason']
-            purchase_request.save()
+            finished, step_changes = decide(purchase_request.approval_steps.all(), approve=True)
+            return None, {'status': 'approved'} if finished else {}, step_changes
+        
+        return self._bulk_transition(serializer.validated_data['ids'], approve, 'approved', now)
+    
+    @action(detail=False, methods=['post'])
+    def bulk_reject(self, request):
+        serializer = BulkRejectionSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        
+        user = request.user
+        now = timezone.now()
+        reason = serializer.validated_data['reason']
+        
+        def reject(purchase_request):
+            if not purchase_request.can_decide(user):
+                if purchase_request.status != 'pending':
+                    return 'Request is not pending', {}, []
+                if user.role not in approver_roles():
+                    return 'Only approvers can reject requests', {}, []
+                return 'You cannot reject this request at this stage', {}, []
             
-            return Response({
-                'message': 'Request rejected',
-                'request': PurchaseRequestSerializer(purchase_request).data
-            })
+            _, step_changes = decide(purchase_request.approval_steps.all(), approve=False)
+            return None, {
+                'status': 'rejected',
+                'rejected_by': user,
+                'rejected_at': now,
+                'rejection_reason': reason,
+            }, step_changes
+        
+        return self._bulk_transition(serializer.validated_data['ids'], reject, 'rejected', now)
     
     @action(detail=True, methods=['post'])
     def submit_receipt(self, request, pk=None):
@@ -214,29 +770,92 @@ class PurchaseRequestViewSet(viewsets.ModelViewSet):
                 status=status.HTTP_400_BAD_REQUEST
             )
         
-        serializer = ReceiptUploadSerializer(data=request.data)
+        if not purchase_request.purchase_order_data:
+            return Response({'error': PO_PENDING_ERROR}, status=status.HTTP_409_CONFLICT)
+        
+        serializer = ReceiptUploadSerializer(data=request.data, context={'request': request})
         if not serializer.is_valid():
             return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
         
         purchase_request.receipt = serializer.validated_data['receipt']
         
-        if purchase_request.purchase_order_data:
-            try:
-                validation_result = validate_receipt(
-                    purchase_request.receipt,
-                    purchase_request.purchase_order_data
-                )
-                purchase_request.receipt_validation = validation_result
-            except Exception as e:
-                purchase_request.receipt_validation = {
-                    'is_valid': False,
-                    'error': str(e)
-                }
+        try:
+            validation_result = validate_receipt(
+                purchase_request.receipt,
+                purchase_request.purchase_order_data
+            )
+            purchase_request.receipt_validation = validation_result
+            purchase_request.receipt_data = validation_result['receipt_data']
+        except Exception as e:
+            purchase_request.receipt_validation = {
+                'is_valid': False,
+                'error': str(e)
+            }
         
-        purchase_request.save()
+        # Only the receipt columns, so a PO or extraction result written by the
+        # document worker meanwhile survives
+        purchase_request.save(update_fields=['receipt', 'receipt_data', 'receipt_validation', 'updated_at'])
+        release_staged(serializer.validated_data['receipt'])
         
         return Response({
             'message': 'Receipt submitted successfully',
             'validation': purchase_request.receipt_validation,
             'request': PurchaseRequestSerializer(purchase_request).data
-        })
\ No newline at end of file
+        })
+
+class ChunkedUploadViewSet(viewsets.ViewSet):
+    """Resumable uploads: POST declares the file, PUT appends a raw chunk at
+    Upload-Offset with its SHA-256 in Upload-Checksum, GET reports the offset
+    to resume from. A complete upload is attached to a request by passing its
+    id as proforma_upload or receipt_upload."""
+    permission_classes = [IsAuthenticated]
+    
+    def get_upload(self, pk):
+        return ChunkedUpload.objects.filter(user=self.request.user, pk=pk).first()
+    
+    def create(self, request):
+        serializer = ChunkedUploadSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+        upload = serializer.save(user=request.user)
+        return Response(ChunkedUploadSerializer(upload).data, status=status.HTTP_201_CREATED)
+    
+    def retrieve(self, request, pk=None):
+        upload = self.get_upload(pk)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        return Response(ChunkedUploadSerializer(upload).data)
+    
+    def update(self, request, pk=None):
+        try:
+            offset = int(request.META['HTTP_UPLOAD_OFFSET'])
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+            checksum = request.META['HTTP_UPLOAD_CHECKSUM']
+        except (KeyError, ValueError):
+            return Response(
+                {'error': 'Upload-Offset, Upload-Checksum and Content-Length headers are required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        upload = self.get_upload(pk)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        try:
+            # The body is read from the request stream, never parsed. WSGI
+            # servers stream it; under ASGI Django has already spooled it
+            # (in memory up to FILE_UPLOAD_MAX_MEMORY_SIZE, then to disk).
+            append_chunk(upload, request.stream, offset, length, checksum)
+        except ChunkError as e:
+            return Response(
+                {'error': str(e), 'offset': upload.offset},
+                status=e.status
+            )
+        
+        return Response(ChunkedUploadSerializer(upload).data)
+    
+    def destroy(self, request, pk=None):
+        upload = self.get_upload(pk)
+        if upload is None:
+            return Response({'error': 'Upload not found'}, status=status.HTTP_404_NOT_FOUND)
+        discard_upload(upload)
+        return Response(status=status.HTTP_204_NO_CONTENT)
@@ -0,0 +1,63 @@
+"""Approval workflow: the levels a request has to pass (settings.APPROVAL_WORKFLOW)
+and the state machine that moves a request's ApprovalSteps along.
+
+Each step is waiting (an earlier level has not approved yet), pending (the
+request's current step, in its role's queue), approved, rejected, or cancelled
+(a lower level rejected the request). The functions here only look at step
+objects and return status changes; ApprovalStepQuerySet.move() writes them."""
+from decimal import Decimal
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+
+DECIDED_STATUSES = ('approved', 'rejected', 'cancelled')
+
+def workflow_levels():
+    """[(level, role, min_amount)] from settings.APPROVAL_WORKFLOW, levels numbered from 1"""
+    levels = []
+    for level, entry in enumerate(settings.APPROVAL_WORKFLOW, start=1):
+        if any(role == entry['role'] for _, role, _ in levels):
+            raise ImproperlyConfigured(f"APPROVAL_WORKFLOW lists {entry['role']} more than once")
+        levels.append((level, entry['role'], Decimal(str(entry.get('min_amount', 0)))))
+    if not levels:
+        raise ImproperlyConfigured('APPROVAL_WORKFLOW needs at least one level')
+    if levels[-1][2]:
+        # Otherwise a small request could be approved without any decision
+        raise ImproperlyConfigured('The last APPROVAL_WORKFLOW level must not have a min_amount')
+    return levels
+
+def approver_roles():
+    return [role for _, role, _ in workflow_levels()]
+
+def levels_for(amount):
+    """(level, role) pairs a request of `amount` has to pass, lowest first"""
+    return [(level, role) for level, role, min_amount in workflow_levels() if Decimal(amount) >= min_amount]
+
+def current_step(steps):
+    return next((step for step in steps if step.status == 'pending'), None)
+
+def activate(steps):
+    """Make the lowest undecided step of a pending request current and the others
+    wait. Returns [(step, new status)] for the steps that change."""
+    changes = []
+    undecided = sorted((step for step in steps if step.status not in DECIDED_STATUSES), key=lambda step: step.level)
+    for i, step in enumerate(undecided):
+        status = 'pending' if i == 0 else 'waiting'
+        if step.status != status:
+            changes.append((step, status))
+    return changes
+
+def decide(steps, approve):
+    """The outcome of the current step approving or rejecting: (whether the request
+    is now finished, [(step, new status)]). Approval hands over to the next level,
+    or finishes the request at the last one; rejection cancels the levels after it."""
+    steps = sorted(steps, key=lambda step: step.level)
+    current = current_step(steps)
+    if current is None:
+        raise ValueError('The request has no step awaiting a decision')
+    later = [step for step in steps if step.level > current.level and step.status == 'waiting']
+    if not approve:
+        return True, [(current, 'rejected')] + [(step, 'cancelled') for step in later]
+    if not later:
+        return True, [(current, 'approved')]
+    return False, [(current, 'approved'), (later[0], 'pending')]
@@ -0,0 +1,103 @@
+import os
+import threading
+
+import psycopg2
+import psycopg2.extras
+from psycopg2 import pool as psycopg2_pool
+from django.db.backends.postgresql import base
+
+POOL_OPTIONS = ('pool_min_size', 'pool_max_size', 'pool_timeout')
+
+class ConnectionPool:
+    """psycopg2's ThreadedConnectionPool, waiting up to `timeout` seconds for a
+    free connection instead of failing as soon as max_size are checked out"""
+
+    def __init__(self, min_size, max_size, timeout, conn_params):
+        self._pool = psycopg2_pool.ThreadedConnectionPool(min_size, max_size, **conn_params)
+        self._slots = threading.BoundedSemaphore(max_size)
+        self.timeout = timeout
+
+    def getconn(self):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise psycopg2.OperationalError(f'No pooled connection became free within {self.timeout}s')
+        try:
+            return self._pool.getconn()
+        except Exception:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection, close=False):
+        # putconn() rolls back an open transaction and discards broken connections
+        try:
+            self._pool.putconn(connection, close=close)
+        finally:
+            self._slots.release()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool(alias, settings_dict, conn_params):
+    # Keyed by process id too: a pool inherited over fork() shares sockets with the parent
+    key = (alias, os.getpid())
+    with _pools_lock:
+        if key not in _pools:
+            options = settings_dict['OPTIONS']
+            _pools[key] = ConnectionPool(
+                int(options.get('pool_min_size', 1)),
+                int(options.get('pool_max_size', 10)),
+                float(options.get('pool_timeout', 10)),
+                conn_params,
+            )
+        return _pools[key]
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    """PostgreSQL backend whose connections come from a per-process pool and go
+    back to it when Django closes them at the end of a request. Under ASGI every
+    request runs in a new thread, so CONN_MAX_AGE cannot reuse connections there."""
+
+    def get_connection_params(self):
+        conn_params = super().get_connection_params()
+        for option in POOL_OPTIONS:
+            conn_params.pop(option, None)
+        return conn_params
+
+    def get_new_connection(self, conn_params):
+        pool = get_pool(self.alias, self.settings_dict, conn_params)
+        while True:
+            connection = pool.getconn()
+            if connection.closed:
+                pool.putconn(connection, close=True)
+                continue
+            if self.settings_dict['CONN_HEALTH_CHECKS'] and not self._ping(connection):
+                # The server dropped it while it sat in the pool
+                pool.putconn(connection, close=True)
+                continue
+            break
+
+        # As in the stock backend; the pooled connection may carry another
+        # request's session settings, which connect() then resets.
+        isolation_level = self.settings_dict['OPTIONS'].get('isolation_level')
+        self.isolation_level = (
+            base.IsolationLevel(isolation_level) if isolation_level is not None
+            else base.IsolationLevel.READ_COMMITTED
+        )
+        if isolation_level is not None:
+            connection.isolation_level = self.isolation_level
+        psycopg2.extras.register_default_jsonb(conn_or_curs=connection, loads=lambda x: x)
+        return connection
+
+    def _ping(self, connection):
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not connection.autocommit:
+                connection.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def _close(self):
+        if self.connection is not None:
+            pool = get_pool(self.alias, self.settings_dict, self.get_connection_params())
+            with self.wrap_database_errors:
+                pool.putconn(self.connection, close=bool(self.connection.closed))
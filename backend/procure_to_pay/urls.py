@@ -9,14 +9,22 @@ from api import views
 
 router = DefaultRouter()
 router.register(r'requests', views.PurchaseRequestViewSet, basename='purchaserequest')
+router.register(r'uploads', views.ChunkedUploadViewSet, basename='upload')
 
 urlpatterns = [
     path('admin/', admin.site.urls),
+    # Before the router, which would read "events" as a request id
+    path('api/requests/events/', views.request_events, name='request_events'),
+    path('api/async/requests/', views.create_request_async, name='create_request_async'),
+    path('api/async/requests/<int:pk>/submit_receipt/', views.submit_receipt_async, name='submit_receipt_async'),
     path('api/', include(router.urls)),
     path('api/auth/register/', views.register, name='register'),
     path('api/auth/login/', TokenObtainPairView.as_view(), name='token_obtain_pair'),
     path('api/auth/refresh/', TokenRefreshView.as_view(), name='token_refresh'),
     path('api/auth/me/', views.current_user, name='current_user'),
+    path('api/analytics/spend/', views.spend_analytics, name='spend_analytics'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('health/', views.health, name='health'),
     path('', TemplateView.as_view(template_name='index.html'), name='home'),
 ]
 
@@ -1,4 +1,5 @@
 ﻿#!/bin/bash
 python manage.py migrate --noinput
 python manage.py collectstatic --noinput
-gunicorn procure_to_pay.wsgi:application --bind 0.0.0.0:8000
+python manage.py process_documents &
+gunicorn procure_to_pay.asgi:application -k uvicorn.workers.UvicornWorker --bind 0.0.0.0:8000